@@ -4,8 +4,37 @@
 """This is the Bob database entry for the BIOWAVE TEST database
 """
 
-from .query import Database
-from .models import Client, File, Protocol, ProtocolPurpose
+import os
+
+# the database file, shipped next to this module
+SQLITE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db.sql3')
+
+# attributes resolved on first access, so that importing this package does not
+# import SQLAlchemy nor open the database
+_lazy_attributes = {
+    'Database': 'query',
+    'Client': 'models',
+    'File': 'models',
+    'Protocol': 'models',
+    'ProtocolPurpose': 'models',
+    'ImageCache': 'cache',
+    'RemoteDatabase': 'service',
+    'SnapshotDatabase': 'snapshot',
+    'read_arrays': 'export',
+    'write_arrays': 'export',
+    }
+
+def __getattr__(name):
+  if name in _lazy_attributes:
+    import importlib
+    module = importlib.import_module('.' + _lazy_attributes[name], __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+  raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
+def __dir__():
+  return sorted(set(globals()) | set(_lazy_attributes))
 
 def get_config():
   """Returns a string containing the configuration information.
@@ -15,4 +44,4 @@ def get_config():
 
 
 # gets sphinx autodoc done right - don't remove it
-__all__ = [_ for _ in dir() if not _.startswith('_')]
+__all__ = [_ for _ in __dir__() if not _.startswith('_') and _ != 'os']
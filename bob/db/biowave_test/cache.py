@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+# Teodors Eglitis <teodors.eglitis@idiap.ch>
+#
+# Copyright (C) 2011-2016 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+On-disk cache of decoded images of the BIOWAVE test database, stored as
+memory-mappable ``.npy`` files.
+"""
+
+import os
+import threading
+
+
+class ImageCache(object):
+  """Keeps decoded images as ``.npy`` files in a directory, keyed by the
+  :py:class:`.File` id and a fingerprint (size and modification time) of the
+  source image, so that a modified image is decoded again.
+
+  Cached images are returned as read-only :py:class:`numpy.memmap` views, so
+  readers on the same node share the page cache instead of decoding the image
+  again. When the total size of the cache exceeds ``max_bytes``, the least
+  recently used entries are removed.
+
+  Keyword Parameters:
+
+  directory
+    The directory holding the cache; it is created if it does not exist and
+    may be shared by several processes.
+
+  max_bytes
+    The maximum total size of the cached files; ``None`` means no limit.
+  """
+
+  def __init__(self, directory, max_bytes = None):
+    self.m_directory = directory
+    self.m_max_bytes = max_bytes
+    self.m_lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    self.m_size = sum(size for _, size, _ in self.__entries__())
+
+  def __entries__(self):
+    """Returns the ``(path, size, mtime)`` of all cached files"""
+
+    retval = []
+    for sub in os.scandir(self.m_directory):
+      if not sub.is_dir(): continue
+      for entry in os.scandir(sub.path):
+        if not entry.name.endswith('.npy'): continue
+        try:
+          stat = entry.stat()
+        except OSError:
+          continue
+        retval.append((entry.path, stat.st_size, stat.st_mtime))
+    return retval
+
+  def __path__(self, file_id, stat):
+    """Returns the path of the cache entry of a file with the given id and
+    source file ``os.stat`` result"""
+
+    name = '%d_%d_%d.npy' % (file_id, stat.st_size, int(stat.st_mtime * 1e9))
+    return os.path.join(self.m_directory, '%02x' % (file_id % 256), name)
+
+  def get(self, file_id, path, loader):
+    """Returns the decoded image of the file with the given id, stored at
+    ``path``, from the cache, or decodes it with ``loader(path)`` and stores it.
+
+    Returns: A read-only :py:class:`numpy.memmap` of the image, or the decoded
+    array if another process removed the new entry before it could be mapped.
+    """
+
+    import numpy
+    cached = self.__path__(file_id, os.stat(path))
+    try:
+      data = numpy.load(cached, mmap_mode = 'r')
+    except (IOError, OSError, ValueError):
+      data = None
+    if data is not None:
+      # the modification time of the entry records when it was last used
+      try:
+        os.utime(cached, None)
+      except OSError:
+        pass
+      with self.m_lock:
+        self.hits += 1
+      return data
+
+    data = numpy.asarray(loader(path))
+    directory = os.path.dirname(cached)
+    if not os.path.exists(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        pass # created concurrently
+    # remove the entries of older versions of the same file
+    prefix = '%d_' % file_id
+    for entry in os.listdir(directory):
+      if entry.startswith(prefix) and entry.endswith('.npy'):
+        self.__remove__(os.path.join(directory, entry))
+    # write to a temporary file first, so that readers never see a partial one
+    temporary = '%s.%d.%d.tmp' % (cached, os.getpid(), threading.current_thread().ident)
+    with open(temporary, 'wb') as f:
+      numpy.save(f, data)
+    os.rename(temporary, cached)
+    with self.m_lock:
+      self.misses += 1
+      self.m_size += os.path.getsize(cached)
+      evict = self.m_max_bytes is not None and self.m_size > self.m_max_bytes
+    if evict:
+      # the new entry is kept, even if it is larger than the cache
+      self.evict(keep = cached)
+    try:
+      return numpy.load(cached, mmap_mode = 'r')
+    except (IOError, OSError):
+      return data
+
+  def __remove__(self, path):
+    """Removes a cached file, returning its size, or 0 if it was already gone"""
+
+    try:
+      size = os.path.getsize(path)
+      os.remove(path)
+    except OSError:
+      return 0
+    with self.m_lock:
+      self.m_size -= size
+    return size
+
+  def evict(self, keep = None):
+    """Removes the least recently used entries, except the one at ``keep``,
+    until the cache fits in ``max_bytes``"""
+
+    entries = sorted(self.__entries__(), key = lambda entry: entry[2])
+    # other processes may have added entries as well
+    with self.m_lock:
+      self.m_size = sum(size for _, size, _ in entries)
+    for path, _, _ in entries:
+      if self.m_max_bytes is None or self.m_size <= self.m_max_bytes: break
+      if path != keep and self.__remove__(path):
+        with self.m_lock:
+          self.evictions += 1
+
+  def size(self):
+    """Returns the total size of the cached files, in bytes"""
+
+    return self.m_size
+
+  def clear(self):
+    """Removes all cached files"""
+
+    for path, _, _ in self.__entries__():
+      self.__remove__(path)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+# Teodors Eglitis <teodors.eglitis@idiap.ch>
+#
+# Copyright (C) 2011-2016 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-memory copy of the BIOWAVE test database tables, indexed by protocol, group,
+purpose, model id and client id, so that queries can be answered without SQL.
+"""
+
+from .models import *
+
+
+class Catalog(object):
+  """Reads the ``client``, ``file``, ``protocol``, ``protocolPurpose`` and
+  ``protocolPurpose_file_association`` tables once and answers the
+  :py:class:`.Database` queries from dictionaries.
+
+  Keyword Parameters:
+
+  db
+    The :py:class:`.Database` to read the tables from.
+  """
+
+  def __init__(self, db):
+    self.protocols = list(db.query(Protocol).order_by(Protocol.id))
+    self.protocol_purposes = list(db.query(ProtocolPurpose).order_by(ProtocolPurpose.id))
+    self.clients_by_id = dict((c.id, c) for c in db.query(Client))
+    self.files_by_id = dict((f.id, f) for f in db.query(File))
+    self.files_by_model_id = dict((f.model_id, f) for f in self.files_by_id.values())
+
+    # (protocol name, group, purpose) -> sorted tuple of file ids
+    names = dict((p.id, p.name) for p in self.protocols)
+    keys = dict((p.id, (names[p.protocol_id], p.sgroup, p.purpose)) for p in self.protocol_purposes)
+    membership = {}
+    a = protocolPurpose_file_association.c
+    for protocolPurpose_id, file_id in db.query(a.protocolPurpose_id, a.file_id):
+      membership.setdefault(keys[protocolPurpose_id], set()).add(file_id)
+    self.membership = dict((k, tuple(sorted(v))) for k, v in membership.items())
+
+    # file id -> sorted list of (protocol name, group, purpose)
+    self.purposes_by_file_id = {}
+    for key, file_ids in sorted(self.membership.items()):
+      for i in file_ids:
+        self.purposes_by_file_id.setdefault(i, []).append(key)
+
+  def protocol_names(self):
+    """Returns all registered protocol names"""
+
+    return [str(p.name) for p in self.protocols]
+
+  def protocol(self, name):
+    """Returns the protocol with the given name, or ``None``"""
+
+    for p in self.protocols:
+      if p.name == name: return p
+    return None
+
+  def __file_ids__(self, protocol, groups, purposes):
+    """Returns the set of ids of files in any of the given protocols, groups
+    and purposes"""
+
+    retval = set()
+    for p in protocol:
+      for g in groups:
+        for u in purposes:
+          retval.update(self.membership.get((p, g, u), ()))
+    return retval
+
+  def clients(self, hands, protocol, groups):
+    """Returns the clients for already validated parameters, in the same order
+    as :py:meth:`.Database.clients`"""
+
+    retval = []
+    for k in groups:
+      client_ids = set(self.files_by_id[i].client_id for i in self.__file_ids__(protocol, (k,), ProtocolPurpose.purpose_choices))
+      retval += [self.clients_by_id[i] for i in sorted(client_ids) if self.clients_by_id[i].hand in hands]
+    return retval
+
+  def model_ids(self, hands, protocol, groups):
+    """Returns the sorted model ids for already validated parameters"""
+
+    files = (self.files_by_id[i] for i in self.__file_ids__(protocol, groups, ('enroll',)))
+    return sorted(set(f.model_id for f in files if self.clients_by_id[f.client_id].hand in hands))
+
+  def objects(self, protocol, groups, purposes, model_ids, order_by = 'id'):
+    """Returns the files for already validated parameters, sorted by the
+    ``order_by`` attribute and the file id"""
+
+    file_ids = self.__file_ids__(protocol, groups, purposes)
+    if model_ids:
+      file_ids = [f.id for f in (self.files_by_model_id.get(m) for m in set(model_ids)) if f is not None and f.id in file_ids]
+    retval = [self.files_by_id[i] for i in sorted(file_ids)]
+    if order_by != 'id':
+      retval.sort(key = lambda f: getattr(f, order_by))
+    return retval
+
+  def object_rows(self, protocol, groups, purposes, model_ids, order_by = 'id', shard = None, num_shards = None):
+    """Returns the ``(id, client_id, model_id, group, purpose, path)`` tuples of
+    :py:meth:`.Database.object_rows` for already validated parameters"""
+
+    objects = self.objects(protocol, groups, purposes, model_ids, order_by)
+    if num_shards is not None:
+      objects = objects[len(objects) * shard // num_shards:len(objects) * (shard + 1) // num_shards]
+    retval = []
+    for f in objects:
+      keys = sorted(set((g, u) for p, g, u in self.purposes_by_file_id[f.id] if p in protocol and g in groups and u in purposes))
+      retval += [(f.id, f.client_id, f.model_id, g, u, f.path) for g, u in keys]
+    return retval
@@ -8,6 +8,8 @@ database with only 20 person's data - in a single pass.
 import os
 import re
 
+from sqlalchemy import bindparam
+
 from .models import *
 
 
@@ -58,7 +60,83 @@ def __test_filelist_for_dublicates__(list_a, list_b):
 
 
 
-def add_clients(session, imagedir, verbose):
+# number of rows sent to the database per ``executemany`` call while bulk
+# loading the tables
+INSERT_BATCH_SIZE = 5000
+
+def __bulk_insert__(session, table, rows, batch_size = INSERT_BATCH_SIZE):
+    """Inserts the given list of row dictionaries into ``table`` using batched
+    ``executemany`` statements inside the current transaction of ``session``.
+    """
+    for start in range(0, len(rows), batch_size):
+        session.execute(table.insert(), rows[start:start + batch_size])
+
+def __list_person_folder__(person_folder_path):
+    """Lists the hand subfolders of a single person folder and the ``.png``
+    images they contain, using one ``os.scandir`` call per directory.
+
+    Returns a list of ``(hand_folder, image)`` name tuples.
+    """
+    images = []
+    for hand_entry in os.scandir(person_folder_path):
+        if not hand_entry.is_dir():
+            continue
+        for image_entry in os.scandir(hand_entry.path):
+            if image_entry.name.endswith(".png"):
+                images.append((hand_entry.name, image_entry.name))
+    return images
+
+def __discover_images__(imagedir, jobs = 1):
+    """Walks the person folders in ``imagedir`` concurrently, using a pool of
+    at most ``jobs`` threads, and returns a sorted manifest of ``(person,
+    hand_folder, image)`` name tuples.
+
+    Listing a directory on a network file system is a slow round-trip, so the
+    person folders are listed in parallel. The manifest is sorted, so it is
+    always the same for the same tree, independently of ``jobs``.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    # get the persons, "scandir" excludes the special entries:
+    persons = sorted(entry.name for entry in os.scandir(imagedir) if entry.is_dir())
+    with ThreadPoolExecutor(max_workers = max(1, jobs)) as executor:
+        listings = executor.map(__list_person_folder__, [os.path.join(imagedir, person) for person in persons])
+        manifest = [(person, hand_folder, image) for person, images in zip(persons, listings) for hand_folder, image in images]
+    manifest.sort()
+    return manifest
+
+def __scan_clients__(imagedir, jobs = 1):
+    """Scans the ``imagedir`` and returns a list of clients found there.
+
+    Each entry of the returned list is a tuple ``(original_client_id, hand,
+    image_short_paths)``, where the image paths are relative to ``imagedir``
+    and exclude the file extension. Clients are listed in the order of the
+    sorted manifest returned by :py:func:`__discover_images__`.
+    """
+    from itertools import groupby
+
+    clients = []
+    manifest = __discover_images__(imagedir, jobs)
+    for person, person_images in groupby(manifest, key = lambda item: item[0]):
+        try:
+            original_client_id = int(re.findall("\d+[\.]?\d*", person)[0])
+        except:
+            raise DatabaseError("Person folder name isn't in an correct form - Person_X or Person X, where X - id - folder's name is - {}".format(person))
+        for person_hand, hand_images in groupby(person_images, key = lambda item: item[1]):
+            person_hand_images = [image for _, _, image in hand_images]
+            if len(person_hand_images) >= 5:
+                if person_hand.startswith("R") == True:
+                    hand = "R"
+                elif person_hand.startswith("L") == True:
+                    hand = "L"
+                else:
+                    raise DatabaseError("Person' s hand folder - {} - don't starts with 'R' or 'L', aborting operation".format(person_hand))
+                image_short_paths = [os.path.splitext(os.path.join(person, person_hand, image))[0] for image in person_hand_images]
+                clients.append((original_client_id, hand, image_short_paths))
+    return clients
+
+
+def add_clients(session, imagedir, verbose, jobs = 1):
   """
   Add clients to the BIOWAVE_TEST database.
 
@@ -68,68 +146,59 @@ def add_clients(session, imagedir, verbose):
   To add cleints, script looks in each person's hand subfolders (Left / Right),
   if they exist, and contains images, hand (a client) is added to the database.
 
-  The Database home dir is defined by the variable "imagedir".
-  """
-  # get the persons, "listdir" excludes the special entries:
-  person_folder_list = os.listdir(imagedir)
-  # sort the person list so that order always is the same:
-  person_folder_list.sort()
-  for person in person_folder_list:
-      try:
-          original_client_id = int(re.findall("\d+[\.]?\d*", person)[0])
-      except:
-          raise DatabaseError("Person folder name isn't in an correct form - Person_X or Person X, where X - id - folder's name is - {}".format(person))
-      person_hand_folder_path = os.path.join(imagedir, person)
-      person_hand_folders = os.listdir(person_hand_folder_path)
-      person_hand_folders.sort()
-      for person_hand in person_hand_folders:
-          person_hand_session_folder_path = os.path.join(person_hand_folder_path, person_hand)
-          person_hand_images = os.listdir(person_hand_session_folder_path)
-          person_hand_images = filter(lambda image: image.endswith(".png") == True, person_hand_images)
-          person_hand_images = list(set(person_hand_images))
-          person_hand_images.sort()
-          if len(person_hand_images) >= 5:
-              if person_hand.startswith("R") == True:
-                  hand = "R"
-              elif person_hand.startswith("L") == True:
-                  hand = "L"
-              else:
-                  raise DatabaseError("Person' s hand folder - {} - don't starts with 'R' or 'L', aborting operation".format(person_hand))
-              if verbose>1: print("  Adding client, client's information:\nOriginal client ID = {}, hand = {}".format(original_client_id, hand))
-              # ADD CLIENT:
-              session.add(Client(original_client_id, hand))
-              # AD CLIENT'S FILES THERE:
-              # To do so, first commit the session so that we can read the user SQL ID:
-              # ADD ALL FILES FOR PARTICULAR CLIENT (relationship - client SQL ID)
-              session.commit()
-              c = session.query(Client).filter(Client.original_client_id == original_client_id).filter(Client.hand == hand).first()
-
-              for nr, image in enumerate(person_hand_images, start=1):
-                  image_full_path = os.path.join(person_hand_session_folder_path, image)
-                  image_short_path = os.path.relpath(image_full_path, imagedir)
-                  image_short_path, _ = os.path.splitext(image_short_path)
-                  if verbose>1: print("    Adding file '{}'...".format(image_short_path))
-                  M = session.query(File).filter(File.model_id == "c_{}_i_{}".format(c.id,nr)).first()
-                  if M:
-                      raise DatabaseError("\n\nAlready exist file's with such MODEL_ID. Possibly SQL database already exist. Please try using command:\n\n     bob_dbmanage.py database_test create -R \n")
-                  else:
-                      session.add(File(c.id, image_short_path, nr))
-
+  The Database home dir is defined by the variable "imagedir", which is
+  scanned with up to "jobs" concurrent directory listings.
 
-def add_protocols(session, devfile, evalfile, verbose):
+  The image tree is scanned first, then client SQL ids, file SQL ids and
+  ``model_id``'s are assigned in Python and the ``client`` and ``file`` tables
+  are loaded with batched inserts. Nothing is committed here, so the whole
+  ingestion happens in a single transaction.
   """
-    Adds protocols
-
-    BIOWAVE_TEST database has only a single protocol - "all". It has purposes:
-      dev - enroll;
-      dev - probe;
-      eval - enroll;
-      eval - probe.
-
-  Clients are added to these protocols using provided text files. If files for \
-  any of the above listed porpuses doubles with different porpuse file, an error
-  is rised.
-
+  clients = __scan_clients__(imagedir, jobs)
+
+  if session.query(Client.id).first() is not None:
+      raise DatabaseError("\n\nAlready exist file's with such MODEL_ID. Possibly SQL database already exist. Please try using command:\n\n     bob_dbmanage.py database_test create -R \n")
+
+  client_rows = []
+  file_rows = []
+  for client_id, (original_client_id, hand, image_short_paths) in enumerate(clients, start=1):
+      if verbose>1: print("  Adding client, client's information:\nOriginal client ID = {}, hand = {}".format(original_client_id, hand))
+      client_rows.append({'id': client_id, 'original_client_id': original_client_id, 'hand': hand})
+      for nr, image_short_path in enumerate(image_short_paths, start=1):
+          if verbose>1: print("    Adding file '{}'...".format(image_short_path))
+          file_rows.append({'id': len(file_rows) + 1, 'client_id': client_id, 'path': image_short_path, 'model_id': "c_{}_i_{}".format(client_id, nr)})
+
+  __bulk_insert__(session, Client.__table__, client_rows)
+  __bulk_insert__(session, File.__table__, file_rows)
+  if verbose:
+      print("Added {} clients and {} files".format(len(client_rows), len(file_rows)))
+
+
+def __build_path_index__(session):
+    """Returns a ``path -> file.id`` dictionary of all files in the database,
+    built with a single query, and the set of paths shared by several files.
+    """
+    path_index = {}
+    ambiguous = set()
+    for file_id, path in session.query(File.id, File.path):
+        if path in path_index:
+            ambiguous.add(path)
+        path_index[path] = file_id
+    return path_index, ambiguous
+
+
+# the (group, purpose) pairs of every protocol, in the order of the lists
+# returned by __resolve_protocols__
+PROTOCOL_PURPOSES = [('dev', 'enroll'), ('dev', 'probe'), ('eval', 'enroll'), ('eval', 'probe')]
+
+def __resolve_protocols__(session, devfile, evalfile):
+  """Reads the dev / eval file lists and resolves them against the files in
+  the database.
+
+  Returns a dictionary ``protocol name -> list of file id lists``, one list
+  per entry of ``PROTOCOL_PURPOSES``. All entries are resolved against a
+  single ``path -> file.id`` index and the ones that can't be resolved are
+  reported together in one :py:class:`DatabaseError`.
   """
   dev_enroll, dev_probe     = __get_filelist__(devfile)
   bad = __test_filelist_for_dublicates__(dev_enroll, dev_probe)
@@ -151,9 +220,54 @@ def add_protocols(session, devfile, evalfile, verbose):
       raise DatabaseError("Doubling {} files between dev / eval filelists, aborting building database protocols.".format(bad))
   protocol_person_definitions = {}
   protocol_person_definitions['all'] = [dev_enroll, dev_probe, eval_enroll, eval_probe]
-  # 2. ADDITIONS TO THE SQL DATABASE
-  protocolPurpose_list = [('dev', 'enroll'), ('dev', 'probe'), ('eval', 'enroll'), ('eval', 'probe')]
+
+  # resolve all file list entries against a single ``path -> file.id`` index
+  path_index, ambiguous = __build_path_index__(session)
+  resolved = {}
+  unresolved = set()
+  multiple = set()
   for proto in protocol_person_definitions:
+    resolved[proto] = []
+    for files_to_add in protocol_person_definitions[proto]:
+      file_ids = []
+      for file_to_add in files_to_add:
+        if file_to_add in ambiguous:
+          multiple.add(file_to_add)
+        elif file_to_add not in path_index:
+          unresolved.add(file_to_add)
+        else:
+          file_ids.append(path_index[file_to_add])
+      resolved[proto].append(file_ids)
+  if unresolved or multiple:
+    message = "Cannot resolve all dev / eval file list entries, aborting building database protocols."
+    if unresolved:
+      message += "\n{} entries have no corresponding file:\n  {}".format(len(unresolved), "\n  ".join(sorted(unresolved)))
+    if multiple:
+      message += "\n{} entries correspond to multiple files:\n  {}".format(len(multiple), "\n  ".join(sorted(multiple)))
+    raise DatabaseError(message)
+  return resolved
+
+
+def add_protocols(session, devfile, evalfile, verbose):
+  """
+    Adds protocols
+
+    BIOWAVE_TEST database has only a single protocol - "all". It has purposes:
+      dev - enroll;
+      dev - probe;
+      eval - enroll;
+      eval - probe.
+
+  Clients are added to these protocols using provided text files. If files for \
+  any of the above listed porpuses doubles with different porpuse file, an error
+  is rised.
+
+  """
+  # resolve all file list entries before touching the protocol tables:
+  resolved = __resolve_protocols__(session, devfile, evalfile)
+
+  # 2. ADDITIONS TO THE SQL DATABASE
+  for proto in resolved:
     current_protocol = Protocol(proto)
     # Add protocol
     if verbose:
@@ -162,9 +276,7 @@ def add_protocols(session, devfile, evalfile, verbose):
     session.flush()
     session.refresh(current_protocol)
     # Add protocol purposes
-    for key in range(len(protocolPurpose_list)):
-      purpose = protocolPurpose_list[key]
-      #print(purpose)
+    for purpose, file_ids in zip(PROTOCOL_PURPOSES, resolved[proto]):
       if verbose > 1:
           print("  Adding protocol purpose ('%s','%s')..." % (purpose[0], purpose[1]))
       prot_purp = ProtocolPurpose(current_protocol.id, purpose[0], purpose[1])
@@ -172,20 +284,183 @@ def add_protocols(session, devfile, evalfile, verbose):
       session.flush()
       session.refresh(prot_purp)
 
-      files_to_add = protocol_person_definitions[proto][key]
-      for file_to_add in files_to_add:
-          print(file_to_add)
-          try:
-              f = session.query(File).filter(File.path == file_to_add).one()
-          except MultipleResultsFound:
-              raise DatabaseError("Multiple files correspond to a single dev / eval file list entry, aborting building database protocols.")
-          if verbose > 1:
-            print("    Adding to the protocol Client's {} file {}...".format(f.client_id, f.path))
+      if verbose > 1:
+          print("    Adding {} files to the protocol purpose...".format(len(file_ids)))
+      # adding files to the protocol purpose:
+      __bulk_insert__(session, protocolPurpose_file_association,
+          [{'protocolPurpose_id': prot_purp.id, 'file_id': file_id} for file_id in file_ids])
+
+  session.commit()
+
+
+def hash_file(path):
+    """Returns a tuple ``(size, mtime, sha256)`` with the size, modification
+    time and hexadecimal SHA-256 digest of the file at ``path``"""
+    import hashlib
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return stat.st_size, stat.st_mtime, digest.hexdigest()
+
+def hash_existing_file(path):
+    """Returns the :py:func:`hash_file` result of the file at ``path``, or
+    ``None`` if it does not exist (anymore)"""
+    try:
+        return hash_file(path)
+    except (IOError, OSError):
+        if os.path.exists(path): raise
+        return None
+
+def hash_files(paths, jobs = 1, ignore_missing = False):
+    """Returns the :py:func:`hash_file` results of all given paths, in the same
+    order, computed on a pool of at most ``jobs`` processes. With
+    ``ignore_missing``, the result of a path that does not exist is ``None``."""
+    function = hash_existing_file if ignore_missing else hash_file
+    if jobs <= 1 or len(paths) <= 1:
+        return [function(path) for path in paths]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers = jobs) as executor:
+        return list(executor.map(function, paths, chunksize = 64))
+
+def add_hashes(session, imagedir, files, verbose, jobs = 1):
+  """Records the size, modification time and content hash of the given files.
+
+  ``files`` is a list of ``(file id, path)`` tuples, where the path is
+  relative to ``imagedir`` and excludes the file extension.
+  """
+  files = list(files)
+  if verbose:
+      print("Hashing {} files...".format(len(files)))
+  hashes = hash_files([os.path.join(imagedir, path + ".png") for _, path in files], jobs)
+  __bulk_insert__(session, FileHash.__table__,
+      [{'file_id': file_id, 'size': size, 'mtime': mtime, 'sha256': sha256} for (file_id, _), (size, mtime, sha256) in zip(files, hashes)])
+
+
+def __bulk_delete__(session, column, values, batch_size = 500):
+    """Deletes all rows of the table of ``column`` whose ``column`` value is in
+    ``values``, in batches that stay below the SQLite variable limit.
+    """
+    values = list(values)
+    for start in range(0, len(values), batch_size):
+        session.execute(column.table.delete().where(column.in_(values[start:start + batch_size])))
+
+def update_database(session, imagedir, devfile, evalfile, verbose, jobs = 1, hashes = False):
+  """Updates an existing database to the current image tree and file lists.
+
+  Only clients and files that appeared in ``imagedir`` are inserted and only
+  the ones that vanished from it are removed; all other rows, and in
+  particular their ``File.id`` and ``model_id`` values, are kept. New images
+  of an existing client are numbered after the highest image number of that
+  client. Protocol purpose associations are then brought in line with the
+  dev / eval file lists. If ``hashes`` is set, the content hashes of the new
+  files are recorded as well.
+
+  Returns a tuple ``(added, removed)`` with the sorted lists of file ids that
+  were inserted and deleted.
+  """
+  clients = __scan_clients__(imagedir, jobs)
+
+  # current state of the database, read with one query per table
+  client_index = dict(((c.original_client_id, c.hand), c.id) for c in session.query(Client.id, Client.original_client_id, Client.hand))
+  existing_files = dict((f.path, f) for f in session.query(File.id, File.client_id, File.path, File.model_id))
+  last_nr = {}
+  for f in existing_files.values():
+    nr = int(f.model_id.rsplit('_', 1)[1])
+    last_nr[f.client_id] = max(nr, last_nr.get(f.client_id, 0))
+  next_client_id = max([0] + list(client_index.values())) + 1
+  next_file_id = max([0] + [f.id for f in existing_files.values()]) + 1
+
+  client_rows = []
+  file_rows = []
+  found_paths = set()
+  for original_client_id, hand, image_short_paths in clients:
+    client_id = client_index.get((original_client_id, hand))
+    if client_id is None:
+      client_id = next_client_id
+      next_client_id += 1
+      client_index[(original_client_id, hand)] = client_id
+      if verbose>1: print("  Adding client, client's information:\nOriginal client ID = {}, hand = {}".format(original_client_id, hand))
+      client_rows.append({'id': client_id, 'original_client_id': original_client_id, 'hand': hand})
+    for image_short_path in image_short_paths:
+      found_paths.add(image_short_path)
+      if image_short_path in existing_files: continue
+      if verbose>1: print("    Adding file '{}'...".format(image_short_path))
+      last_nr[client_id] = last_nr.get(client_id, 0) + 1
+      file_rows.append({'id': next_file_id, 'client_id': client_id, 'path': image_short_path, 'model_id': "c_{}_i_{}".format(client_id, last_nr[client_id])})
+      next_file_id += 1
+
+  removed = sorted(f.id for path, f in existing_files.items() if path not in found_paths)
+  if verbose>1:
+    for path in sorted(set(existing_files) - found_paths): print("    Removing file '{}'...".format(path))
+  __bulk_delete__(session, protocolPurpose_file_association.c.file_id, removed)
+  __bulk_delete__(session, FileHash.file_id, removed)
+  __bulk_delete__(session, File.id, removed)
+  __bulk_insert__(session, Client.__table__, client_rows)
+  __bulk_insert__(session, File.__table__, file_rows)
+  if hashes:
+    add_hashes(session, imagedir, [(row['id'], row['path']) for row in file_rows], verbose, jobs)
+
+  # clients left without any file vanished from the image tree as well
+  kept_clients = set(client_id for (client_id,) in session.query(File.client_id).distinct())
+  __bulk_delete__(session, Client.id, sorted(set(client_index.values()) - kept_clients))
+
+  # bring the protocol purpose associations in line with the file lists
+  resolved = __resolve_protocols__(session, devfile, evalfile)
+  purpose_index = dict(((p.name, p.sgroup, p.purpose), p.id) for p in session.query(Protocol.name, ProtocolPurpose.sgroup, ProtocolPurpose.purpose, ProtocolPurpose.id).join(ProtocolPurpose, ProtocolPurpose.protocol_id == Protocol.id))
+  wanted = set()
+  for proto in resolved:
+    for (sgroup, purpose), file_ids in zip(PROTOCOL_PURPOSES, resolved[proto]):
+      if (proto, sgroup, purpose) not in purpose_index:
+        raise DatabaseError("Protocol purpose ('{}', '{}', '{}') does not exist in the database, please use 'create -R' to re-create it".format(proto, sgroup, purpose))
+      wanted.update((purpose_index[(proto, sgroup, purpose)], file_id) for file_id in file_ids)
+  a = protocolPurpose_file_association.c
+  current = set(session.query(a.protocolPurpose_id, a.file_id))
+  obsolete = [{'pp_id': protocolPurpose_id, 'f_id': file_id} for protocolPurpose_id, file_id in sorted(current - wanted)]
+  if obsolete:
+    session.execute(protocolPurpose_file_association.delete().where(a.protocolPurpose_id == bindparam('pp_id')).where(a.file_id == bindparam('f_id')), obsolete)
+  __bulk_insert__(session, protocolPurpose_file_association,
+      [{'protocolPurpose_id': protocolPurpose_id, 'file_id': file_id} for protocolPurpose_id, file_id in sorted(wanted - current)])
+
+  add_membership(session, verbose)
+  session.commit()
+
+  return [row['id'] for row in file_rows], removed
+
+
+def add_membership(session, verbose):
+  """(Re-)materialises the :py:class:`.FileMembership` table from the
+  normalised tables"""
+
+  if verbose: print("Materialising the file memberships...")
+  table = FileMembership.__table__
+  session.execute(table.delete())
+  columns = ['file_id', 'client_id', 'hand', 'model_id', 'path', 'protocol', 'sgroup', 'purpose']
+  session.execute(table.insert().from_select(columns, membership_select()))
+
 
-          # adding file to the protocol purpose:
-          prot_purp.files.append(f)
+def add_snapshot(session, dbfile, verbose):
+  """Stores a new build token in the database and reads the catalog for the
+  snapshot of the database file; returns a function that writes the snapshot
+  and must be called once the session is closed, so that the snapshot records
+  the final state of the file"""
 
+  import random
+  from sqlalchemy import text
+  from .snapshot import write_snapshot, snapshot_file
+  if verbose: print("Writing the catalog snapshot...")
+  # the token tells which build of the database file a snapshot belongs to
+  session.execute(text('PRAGMA user_version = %d' % random.SystemRandom().randint(1, 2**31 - 1)))
   session.commit()
+  protocols = [name for (name,) in session.query(Protocol.name).order_by(Protocol.id)]
+  files = [tuple(f) for f in session.query(File.id, File.client_id, Client.hand, File.model_id, File.path).join(Client, File.client_id == Client.id)]
+  m = FileMembership.__table__.c
+  membership = [tuple(r) for r in session.query(m.protocol, m.sgroup, m.purpose, m.file_id)]
+  def write():
+    write_snapshot(snapshot_file(dbfile), dbfile, protocols, ProtocolPurpose.group_choices,
+        ProtocolPurpose.purpose_choices, Client.hand_choices, files, membership)
+  return write
 
 
 def create_tables(args):
@@ -195,38 +470,95 @@ def create_tables(args):
   engine = create_engine_try_nolock(args.type, args.files[0], echo=(args.verbose > 2))
   Base.metadata.create_all(engine)
 
+  # existing tables, e.g. when updating, do not get the new indexes otherwise
+  from sqlalchemy import inspect
+  inspector = inspect(engine)
+  for table in Base.metadata.sorted_tables:
+    existing = set(index['name'] for index in inspector.get_indexes(table.name))
+    for index in table.indexes:
+      if index.name not in existing:
+        index.create(engine)
+
+
+def analyze(session, verbose):
+  """Gathers the statistics the SQLite query planner uses to pick indexes"""
+
+  from sqlalchemy import text
+  if verbose: print("Analyzing the database...")
+  session.execute(text('ANALYZE'))
+  session.commit()
+
 # Driver API
 # ==========
 
 def create(args):
   """Creates or re-creates this database"""
 
-  from bob.db.base.utils import session_try_nolock
+  from .query import building_marker
 
   dbfile = args.files[0]
+  if not os.path.exists(os.path.dirname(dbfile)):
+    os.makedirs(os.path.dirname(dbfile))
+
+  # tells read-only readers that the file can't be opened as immutable
+  marker = building_marker(dbfile)
+  open(marker, 'w').close()
+  try:
+    __create__(args, dbfile)
+  finally:
+    os.unlink(marker)
+
+
+def __create__(args, dbfile):
+  """Does the work of :py:func:`create` on the given database file"""
+
+  from bob.db.base.utils import session_try_nolock
+
+  if args.update:
+    if args.recreate:
+      raise DatabaseError("The options --recreate and --update can't be used together")
+    if not os.path.exists(dbfile):
+      raise DatabaseError("The database file '{}' does not exist, so it can't be updated; please run 'create' without --update first".format(dbfile))
+    import sys
+    import json
+    import contextlib
+    # the JSON delta is the only output on stdout, the progress goes to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+      create_tables(args)
+      s = session_try_nolock(args.type, dbfile, echo=(args.verbose > 2))
+      added, removed = update_database(s, args.imagedir, args.devfile, args.evalfile, args.verbose, args.jobs, args.hash)
+      analyze(s, args.verbose)
+      snapshot = add_snapshot(s, dbfile, args.verbose)
+      s.close()
+      snapshot()
+    print(json.dumps({'added': added, 'removed': removed}))
+    return
 
   if args.recreate:
     if args.verbose and os.path.exists(dbfile):
       print('unlinking %s...' % dbfile)
     if os.path.exists(dbfile): os.unlink(dbfile)
 
-  if not os.path.exists(os.path.dirname(dbfile)):
-    os.makedirs(os.path.dirname(dbfile))
-
   # ALL THE WORK:
   #----------------------------------------------------------------------------
   create_tables(args)
   s = session_try_nolock(args.type, dbfile, echo=(args.verbose > 2))
-  add_clients(s, args.imagedir, args.verbose)
+  add_clients(s, args.imagedir, args.verbose, args.jobs)
+  if args.hash:
+    add_hashes(s, args.imagedir, s.query(File.id, File.path).order_by(File.id), args.verbose, args.jobs)
 
   #add_annotations(s, args.annotdir, args.verbose)
   #add_protocols(s, args)
 
 
   add_protocols(s, args.devfile, args.evalfile, args.verbose)
+  add_membership(s, args.verbose)
 
   s.commit()
+  analyze(s, args.verbose)
+  snapshot = add_snapshot(s, dbfile, args.verbose)
   s.close()
+  snapshot()
 
 
 def add_command(subparsers):
@@ -235,9 +567,12 @@ def add_command(subparsers):
   parser = subparsers.add_parser('create', help=create.__doc__)
 
   parser.add_argument('-R', '--recreate', action='store_true', help="If set, I'll first erase the current database")
-  parser.add_argument('-v', '--verbose', action='count', help="Do SQL operations in a verbose way?")
+  parser.add_argument('-U', '--update', action='store_true', help="If set, I'll only add the clients and files that are new in the image directory, remove the ones that vanished and update the protocols accordingly; the ids of the added and removed files are printed as JSON")
+  parser.add_argument('-v', '--verbose', action='count', default=0, help="Do SQL operations in a verbose way?")
   parser.add_argument('-D', '--imagedir', metavar='DIR', default='/idiap/project/biowave/biowave_test/database/', help="Change the relative path to the directory containing the images of the BIOWAVE database.")
   parser.add_argument('-e', '--evalfile', metavar='DIR', default='/idiap/project/biowave/biowave_test/evalSetGenuine.txt', help="Change the path and file name containing the evaluate group's file list of the BIOWAVE_TEST database (defaults to %(default)s)")
+  parser.add_argument('-j', '--jobs', type=int, default=8, help="Number of person folders listed concurrently while scanning the image directory, and of processes used to hash the images (defaults to %(default)s)")
+  parser.add_argument('-H', '--hash', action='store_true', help="If set, I'll also record the size, modification time and SHA-256 hash of every image, so that 'checkfiles --verify' can detect modified files")
   parser.add_argument('-d', '--devfile', metavar='DIR', default='/idiap/project/biowave/biowave_test/devSetGenuine.txt', help="Change the path and file name containing the develop group's file list of the BIOWAVE_TEST database (defaults to %(default)s)")
 
   parser.set_defaults(func=create) #action
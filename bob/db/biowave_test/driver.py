@@ -6,31 +6,268 @@
 
 import os
 import sys
-from .create import *
 from bob.db.base.driver import Interface as BaseInterface
 
+def check_choices(args, db):
+  """Checks the command line arguments whose valid values are only known once
+  the database is opened. Returns an error message, or ``None`` if all values
+  are valid."""
+
+  checks = (
+      ('protocol', db.protocol_names),
+      ('purpose', db.purposes),
+      ('group', db.groups),
+      ('models', db.model_ids),
+      )
+  for name, choices in checks:
+    value = getattr(args, name, None)
+    if value is not None and value not in choices():
+      return "argument --%s: invalid choice: '%s' (choose from %s)" % (name, value, ', '.join("'%s'" % k for k in choices()))
+  return None
+
+def check_shard(args):
+  """Checks the ``--shard`` and ``--num-shards`` command line arguments.
+  Returns an error message, or ``None`` if they are valid."""
+
+  shard, num_shards = getattr(args, 'shard', None), getattr(args, 'num_shards', None)
+  if shard is None and num_shards is None:
+    return None
+  if shard is None:
+    return "argument --num-shards: requires --shard"
+  if num_shards is None:
+    return "argument --shard: requires --num-shards"
+  if num_shards < 1:
+    return "argument --num-shards: invalid value: %d (must be at least 1)" % num_shards
+  if not 0 <= shard < num_shards:
+    return "argument --shard: invalid value: %d (choose from 0 to %d)" % (shard, num_shards - 1)
+  return None
+
 def dumplist(args):
   """Dumps lists of files based on your criteria"""
 
   from .query import Database
   db = Database()
 
-  r = db.objects(
+  error = check_choices(args, db) or check_shard(args)
+  if error is not None:
+    sys.stderr.write('%s\n' % error)
+    return 1
+
+  rows = db.object_rows(
         protocol     = args.protocol,
         groups       = args.group,
         purposes     = args.purpose,
-        model_ids    = args.models)
+        model_ids    = args.models,
+        batch_size   = args.batch_size,
+        shard        = args.shard,
+        num_shards   = args.num_shards)
   output = sys.stdout
 
   if args.selftest:
     from bob.db.base.utils import null
     output = null()
 
-  for f in r:
-    output.write('%s\n' % (f.make_path(args.directory, args.extension),))
+  write_rows(output, rows, args.format, args.directory, args.extension, args.batch_size)
+  output.flush()
 
   return 0
 
+def write_rows(output, rows, format, directory, extension, batch_size = 1000):
+  """Writes the ``(id, client_id, model_id, group, purpose, path)`` tuples of
+  :py:meth:`.Database.object_rows` to ``output`` in the given format.
+
+  The ``plain`` and ``null`` formats write each file path once, terminated by
+  a new line or a NUL character. The ``csv`` and ``jsonl`` formats write one
+  record per row, carrying the ids, group and purpose alongside the path. Each
+  batch of ``batch_size`` rows is written with a single call.
+  """
+
+  import itertools
+  directory = directory or ''
+  extension = extension or ''
+  fields = ('id', 'client_id', 'model_id', 'group', 'purpose', 'path')
+
+  if format == 'csv':
+    import csv
+    writer = csv.writer(output, lineterminator = '\n')
+    writer.writerow(fields)
+  elif format == 'jsonl':
+    import json
+
+  last_id = None
+  rows = iter(rows)
+  while True:
+    batch = list(itertools.islice(rows, batch_size))
+    if not batch: break
+    if format in ('plain', 'null'):
+      terminator = '\n' if format == 'plain' else '\0'
+      paths = []
+      for row in batch:
+        # a file listed for several groups or purposes is only written once
+        if row[0] == last_id: continue
+        last_id = row[0]
+        paths.append(os.path.join(directory, row[5] + extension) + terminator)
+      output.write(''.join(paths))
+    elif format == 'csv':
+      writer.writerows(row[:5] + (os.path.join(directory, row[5] + extension),) for row in batch)
+    else:
+      output.write(''.join(json.dumps(dict(zip(fields, row[:5] + (os.path.join(directory, row[5] + extension),)))) + '\n' for row in batch))
+
+def trials(args):
+  """Writes the enroll x probe trials of each group to a NumPy file"""
+
+  from .query import Database
+  db = Database()
+
+  error = check_choices(args, db)
+  if error is not None:
+    sys.stderr.write('%s\n' % error)
+    return 1
+
+  output = sys.stdout
+  if args.selftest:
+    from bob.db.base.utils import null
+    output = null()
+
+  for group in ((args.group,) if args.group else db.groups()):
+    filename = args.output.format(group=group)
+    t = db.trials(group, protocol=args.protocol, filename=filename)
+    output.write('%s: %d trials of %d models written to "%s"\n' % (group, len(t), len(db.model_ids(protocol=args.protocol, groups=group)), filename))
+
+  return 0
+
+def export(args):
+  """Writes the file catalog as columnar arrays to a .npz, Arrow or Parquet file"""
+
+  from .query import Database
+  from .export import write_arrays, has_arrow
+  db = Database()
+
+  error = check_choices(args, db)
+  if error is not None:
+    sys.stderr.write('%s\n' % error)
+    return 1
+
+  format = args.format
+  if format == 'auto':
+    format = 'parquet' if has_arrow() else 'npz'
+  if format != 'npz' and not has_arrow():
+    sys.stderr.write("The format '%s' requires pyarrow, which is not installed; please use --format=npz\n" % format)
+    return 1
+  filename = args.output.format(ext=format)
+
+  output = sys.stdout
+  if args.selftest:
+    from bob.db.base.utils import null
+    output = null()
+
+  arrays = db.to_arrays(protocol=args.protocol)
+  write_arrays(arrays, filename, format)
+  output.write('%d files written to "%s"\n' % (len(arrays['file_id']), filename))
+
+  return 0
+
+
+def list_directory(directory):
+  """Returns the set of entry names in the given directory, which is empty if
+  the directory does not exist or can't be read"""
+
+  try:
+    return set(os.listdir(directory))
+  except OSError:
+    return set()
+
+def missing_paths(paths, jobs = 1):
+  """Returns the list of the given paths that do not exist.
+
+  Instead of one ``stat`` per path, the paths are grouped by directory and
+  each directory is listed only once; the listings run concurrently on a pool
+  of at most ``jobs`` threads.
+  """
+
+  from concurrent.futures import ThreadPoolExecutor
+
+  directories = {}
+  for p in paths:
+    directories.setdefault(os.path.dirname(p), set())
+  with ThreadPoolExecutor(max_workers = max(1, jobs)) as executor:
+    for directory, names in zip(list(directories), executor.map(list_directory, list(directories))):
+      directories[directory] = names
+  return [p for p in paths if os.path.basename(p) not in directories[os.path.dirname(p)]]
+
+def modified_paths(session, dbfile, objects, paths, jobs = 1, update_hashes = False):
+  """Returns a tuple ``(modified, unverified, rehashed, vanished)`` for the
+  given existing files and their paths.
+
+  ``modified`` lists the paths whose contents differ from the hash recorded by
+  ``create --hash``, ``unverified`` the paths without a recorded hash and
+  ``vanished`` the paths that were removed while they were checked. Only files
+  whose size or modification time changed are hashed again; their number is
+  returned as ``rehashed``. The database is only read, so files that were
+  just copied or touched are hashed again by every check, unless
+  ``update_hashes`` is set: then, for the files whose contents did not change,
+  the new size and modification time are recorded in ``dbfile``, while its
+  :py:func:`.building_marker` tells the read-only readers not to open it as
+  immutable. Nothing is recorded if ``dbfile`` can't be written.
+  """
+
+  from sqlalchemy.exc import OperationalError
+  from .models import FileHash
+  from .create import hash_files
+
+  try:
+    stored = dict((h.file_id, h) for h in session.query(FileHash))
+  except OperationalError:
+    # database created before hashes were recorded
+    stored = {}
+
+  unverified = []
+  vanished = []
+  changed = []
+  for f, path in zip(objects, paths):
+    h = stored.get(f.id)
+    if h is None:
+      unverified.append(path)
+      continue
+    try:
+      stat = os.stat(path)
+    except OSError:
+      vanished.append(path)
+      continue
+    if stat.st_size != h.size or stat.st_mtime != h.mtime:
+      changed.append((path, h))
+
+  hashes = hash_files([path for path, _ in changed], jobs, ignore_missing = True)
+  modified = []
+  refreshed = []
+  for (path, h), result in zip(changed, hashes):
+    if result is None:
+      vanished.append(path)
+    elif result[2] != h.sha256:
+      modified.append(path)
+    else:
+      refreshed.append({'f_id': h.file_id, 'f_size': result[0], 'f_mtime': result[1]})
+
+  if update_hashes and refreshed:
+    from sqlalchemy import bindparam
+    from bob.db.base.utils import session_try_nolock
+    from .query import building_marker
+    marker = building_marker(dbfile)
+    try:
+      open(marker, 'w').close()
+      try:
+        s = session_try_nolock('sqlite', dbfile)
+        try:
+          s.execute(FileHash.__table__.update().where(FileHash.file_id == bindparam('f_id')).values(size = bindparam('f_size'), mtime = bindparam('f_mtime')), refreshed)
+          s.commit()
+        finally:
+          s.close()
+      finally:
+        os.unlink(marker)
+    except (IOError, OSError, OperationalError):
+      pass # e.g. a read-only installation
+  return modified, unverified, len(changed), vanished
+
 def checkfiles(args):
   """Checks existence of files based on your criteria"""
 
@@ -40,13 +277,15 @@ def checkfiles(args):
   r = db.objects()
 
   # go through all files, check if they are available on the filesystem
-  good = []
-  bad = []
-  for f in r:
-    if os.path.exists(f.make_path(args.directory, args.extension)):
-      good.append(f)
-    else:
-      bad.append(f)
+  bad = missing_paths([f.make_path(args.directory, args.extension) for f in r], args.jobs)
+
+  if args.verify:
+    missing = set(bad)
+    found = [(f, f.make_path(args.directory, args.extension)) for f in r]
+    found = [(f, p) for f, p in found if p not in missing]
+    from . import SQLITE_FILE
+    modified, unverified, rehashed, vanished = modified_paths(db, SQLITE_FILE, [f for f, _ in found], [p for _, p in found], args.jobs, args.update_hashes)
+    bad += vanished
 
   # report
   output = sys.stdout
@@ -54,11 +293,34 @@ def checkfiles(args):
     from bob.db.base.utils import null
     output = null()
 
-  if bad:
-    for f in bad:
-      output.write('Cannot find file "%s"\n' % (f.make_path(args.directory, args.extension),))
-    output.write('%d files (out of %d) were not found at "%s"\n' % \
-      (len(bad), len(r), args.directory))
+  if args.json:
+    import json
+    summary = {
+      'directory': args.directory,
+      'total': len(r),
+      'found': len(r) - len(bad),
+      'missing': bad,
+      }
+    if args.verify:
+      summary.update({
+        'modified': modified,
+        'unverified': len(unverified),
+        'rehashed': rehashed,
+        })
+    output.write('%s\n' % json.dumps(summary))
+  else:
+    if bad:
+      for f in bad:
+        output.write('Cannot find file "%s"\n' % (f,))
+      output.write('%d files (out of %d) were not found at "%s"\n' % \
+        (len(bad), len(r), args.directory))
+    if args.verify:
+      for f in modified:
+        output.write('File "%s" was modified since its hash was recorded\n' % (f,))
+      if modified:
+        output.write('%d files (out of %d re-hashed) were modified\n' % (len(modified), rehashed))
+      if unverified:
+        output.write('%d files have no recorded hash and were not verified; use "create --hash" to record them\n' % (len(unverified),))
 
   return 0
 
@@ -75,6 +337,7 @@ def reverse(args):
   try:
       r = db.reverse(args.path)
   except KeyError as err:
+    from .create import DatabaseError
     raise DatabaseError("One or more of the input paths wasn't found - original error message:\nKeyError: {}".format(err))
 
   for f in r: output.write('%d\n' % f.id)
@@ -101,6 +364,35 @@ def path(args):
 
   return 0
 
+def serve(args):
+  """Answers database queries as JSON over a local HTTP port or Unix socket"""
+
+  from .service import make_server
+  server = make_server(host=args.host, port=args.port, socket_path=args.socket, in_memory=args.in_memory, pool_size=args.pool_size, verbose=args.verbose, cache_bytes=args.cache_size * 1024 * 1024)
+
+  output = sys.stdout
+  if args.selftest:
+    from bob.db.base.utils import null
+    output = null()
+
+  if args.socket is not None:
+    output.write('serving on unix socket "%s"\n' % args.socket)
+  else:
+    output.write('serving on http://%s:%d/\n' % server.server_address[:2])
+  output.flush()
+
+  try:
+    if not args.selftest:
+      server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    if args.socket is not None and os.path.exists(args.socket):
+      os.unlink(args.socket)
+
+  return 0
+
 
 class Interface(BaseInterface):
 
@@ -113,9 +405,10 @@ class Interface(BaseInterface):
 
   def files(self):
 
-    from pkg_resources import resource_filename
-    raw_files = ('db.sql3',)
-    return [resource_filename(__name__, k) for k in raw_files]
+    # the snapshot written by 'create' is not part of the published archive,
+    # so it is not listed; without it, queries go to db.sql3
+    from . import SQLITE_FILE
+    return [SQLITE_FILE]
 
   def type(self):
     return 'sqlite'
@@ -131,26 +424,41 @@ class Interface(BaseInterface):
     from .create import add_command as create_command
     create_command(subparsers)
 
-    from .query import Database
+    # the database is not opened here, so that registering the commands
+    # stays cheap; values are checked when the command is run
     import argparse
-    db = Database()
 
     # example: get the "dumplist" action from a submodule
     parser = subparsers.add_parser('dumplist', help=dumplist.__doc__)
     parser.add_argument('-d', '--directory', default='',   help="if given, this path will be prepended to every entry returned.")
     parser.add_argument('-e', '--extension', default='',   help="if given, this extension will be appended to every entry returned.")
-    parser.add_argument('-p', '--protocol',  help="if given, limits the dump to a particular subset of the data that corresponds to the given protocol.", choices=db.protocol_names() if db.is_valid() else ())
-    parser.add_argument('-u', '--purpose',   help="if given, this value will limit the output files to those designed for the given purposes.", choices=db.purposes() if db.is_valid() else ())
-    #parser.add_argument('-c', '--client',    type=int, help="if given, this value will limit the output files to those belonging to a particular protocolar group.", choices=db.model_ids() if db.is_valid() else ())
-    parser.add_argument('-m', '--models', type=str, help="if given, limits the dump to a particular model", choices=db.model_ids() if db.is_valid() else ())
-    parser.add_argument('-g', '--group',     help="if given, this value will limit the output files to those belonging to a particular protocolar group.", choices=db.groups() if db.is_valid() else ())
+    parser.add_argument('-p', '--protocol',  help="if given, limits the dump to a particular subset of the data that corresponds to the given protocol.")
+    parser.add_argument('-u', '--purpose',   help="if given, this value will limit the output files to those designed for the given purposes.")
+    parser.add_argument('-m', '--models', type=str, help="if given, limits the dump to a particular model")
+    parser.add_argument('-g', '--group',     help="if given, this value will limit the output files to those belonging to a particular protocolar group.")
+    parser.add_argument('-f', '--format', default='plain', choices=('plain', 'null', 'csv', 'jsonl'), help="the output format: one path per line (plain), NUL-terminated paths (null), or CSV / JSON-lines records with id, client_id, model_id, group, purpose and path (defaults to %(default)s)")
+    parser.add_argument('-b', '--batch-size', dest="batch_size", type=int, default=1000, help="number of entries read from the database and written at once (defaults to %(default)s)")
+    parser.add_argument('-s', '--shard', type=int, help="if given together with --num-shards, only dumps this part (counting from 0) of the list; e.g. the SGE_TASK_ID - 1 of a grid array job.")
+    parser.add_argument('-n', '--num-shards', dest="num_shards", type=int, help="the number of parts the list is split into with --shard; all parts together contain every entry exactly once.")
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=dumplist) #action
 
+    # the "trials" action
+    parser = subparsers.add_parser('trials', help=trials.__doc__)
+    parser.add_argument('-p', '--protocol',  help="if given, uses the given protocol instead of the first one.")
+    parser.add_argument('-g', '--group',     help="if given, only writes the trials of the given group instead of all groups.")
+    parser.add_argument('-o', '--output', default='trials_{group}.npy', help="the file the trials are written to, '{group}' is replaced by the group name (defaults to %(default)s)")
+    parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
+    parser.set_defaults(func=trials) #action
+
     # the "checkfiles" action
     parser = subparsers.add_parser('checkfiles', help=checkfiles.__doc__)
     parser.add_argument('-d', '--directory', default='/idiap/project/biowave/biowave_test/database/', help="if given, this path will be prepended to every entry returned.")
     parser.add_argument('-e', '--extension', default='.png', help="if given, this extension will be appended to every entry returned.")
+    parser.add_argument('-j', '--jobs', type=int, default=8, help="number of directories listed concurrently (defaults to %(default)s)")
+    parser.add_argument('--verify', action='store_true', help="if given, the contents of the files are also compared to the hashes recorded by 'create --hash'; only files whose size or modification time changed are hashed again.")
+    parser.add_argument('--update-hashes', dest="update_hashes", action='store_true', help="if given with --verify, the new size and modification time of files whose contents did not change are written to the database file, so that they are not hashed again by the next check.")
+    parser.add_argument('--json', action='store_true', help="if given, a JSON summary with the number of found files and the list of missing files is written instead of the plain report.")
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=checkfiles) #action
 
@@ -168,3 +476,23 @@ class Interface(BaseInterface):
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=path) #action
 
+    # the "export" action
+    parser = subparsers.add_parser('export', help=export.__doc__)
+    parser.add_argument('-p', '--protocol',  help="if given, the group and purpose membership of this protocol is exported instead of the one of the first protocol.")
+    parser.add_argument('-f', '--format', default='auto', choices=('auto', 'npz', 'arrow', 'parquet'), help="the file format; 'auto' writes Parquet if pyarrow is installed and .npz otherwise (defaults to %(default)s)")
+    parser.add_argument('-o', '--output', default='biowave_test_catalog.{ext}', help="the file the catalog is written to, '{ext}' is replaced by the extension of the format (defaults to %(default)s)")
+    parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
+    parser.set_defaults(func=export) #action
+
+    # the "serve" action
+    parser = subparsers.add_parser('serve', help=serve.__doc__)
+    parser.add_argument('-H', '--host', default='127.0.0.1', help="the address to listen on (defaults to %(default)s)")
+    parser.add_argument('-P', '--port', type=int, default=8765, help="the TCP port to listen on (defaults to %(default)s)")
+    parser.add_argument('-S', '--socket', help="if given, listens on this Unix socket instead of the TCP port.")
+    parser.add_argument('-m', '--in-memory', dest="in_memory", action='store_true', help="if given, the tables are read into memory once and queries are answered without SQL.")
+    parser.add_argument('-j', '--pool-size', dest="pool_size", type=int, default=4, help="the number of database connections answering queries concurrently (defaults to %(default)s)")
+    parser.add_argument('-c', '--cache-size', dest="cache_size", type=int, default=64, help="the maximum size of the cached responses, in MiB; the least recently used ones are dropped first (defaults to %(default)s)")
+    parser.add_argument('-v', '--verbose', action='store_true', help="if given, every request is logged to stderr.")
+    parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
+    parser.set_defaults(func=serve) #action
+
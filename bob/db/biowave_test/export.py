@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+# Teodors Eglitis <teodors.eglitis@idiap.ch>
+#
+# Copyright (C) 2011-2016 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Reading and writing the columnar catalog returned by
+:py:meth:`.Database.to_arrays` as ``.npz``, Arrow or Parquet files.
+"""
+
+import os
+
+
+# file formats, by file name extension
+FORMATS = {
+  '.npz': 'npz',
+  '.arrow': 'arrow',
+  '.feather': 'arrow',
+  '.parquet': 'parquet',
+  }
+
+
+def has_arrow():
+  """Tells if ``pyarrow`` is available, to write Arrow and Parquet files"""
+
+  try:
+    import pyarrow
+    return True
+  except ImportError:
+    return False
+
+
+def file_format(filename, format = None):
+  """Returns the format of the given file, either the given ``format`` or the
+  one of its extension"""
+
+  if format is None:
+    format = FORMATS.get(os.path.splitext(filename)[1].lower())
+    if format is None:
+      raise ValueError("The format of '%s' is unknown, please use one of the extensions %s" % (filename, ', '.join(sorted(FORMATS))))
+  if format not in FORMATS.values():
+    raise ValueError("The format '%s' is unknown, please use one of %s" % (format, ', '.join(sorted(set(FORMATS.values())))))
+  return format
+
+
+def write_arrays(arrays, filename, format = None):
+  """Writes a dictionary of 1D arrays of the same length to a ``.npz``,
+  Arrow (``.arrow``, ``.feather``) or Parquet (``.parquet``) file; the latter
+  two require ``pyarrow``.
+
+  Keyword Parameters:
+
+  arrays
+    The dictionary of arrays, as returned by :py:meth:`.Database.to_arrays`.
+
+  filename
+    The file to write.
+
+  format
+    One of ('npz', 'arrow', 'parquet'); by default, the format of the
+    extension of ``filename``.
+  """
+
+  format = file_format(filename, format)
+  if format == 'npz':
+    import numpy
+    with open(filename, 'wb') as f:
+      numpy.savez(f, **arrays)
+    return
+
+  import pyarrow
+  table = pyarrow.table(arrays)
+  if format == 'parquet':
+    import pyarrow.parquet
+    pyarrow.parquet.write_table(table, filename)
+  else:
+    import pyarrow.feather
+    pyarrow.feather.write_feather(table, filename, compression = 'uncompressed')
+
+
+def read_arrays(filename, format = None):
+  """Reads the arrays written by :py:func:`write_arrays`, all at once.
+
+  Arrow files are memory mapped. The result can be handed to
+  ``pandas.DataFrame`` directly.
+
+  Returns: A dictionary of 1D NumPy arrays.
+  """
+
+  format = file_format(filename, format)
+  if format == 'npz':
+    import numpy
+    with numpy.load(filename, allow_pickle = False) as data:
+      return dict((name, data[name]) for name in data.files)
+
+  if format == 'parquet':
+    import pyarrow.parquet
+    table = pyarrow.parquet.read_table(filename)
+  else:
+    import pyarrow.feather
+    table = pyarrow.feather.read_table(filename, memory_map = True)
+  return dict((name, table.column(name).to_numpy()) for name in table.column_names)
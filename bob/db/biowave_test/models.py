@@ -23,7 +23,7 @@ database with only 20 person's data
 
 
 import bob.db.base.utils
-from sqlalchemy import Table, Column, Integer, String, ForeignKey, or_, and_
+from sqlalchemy import Table, Column, Index, Integer, Float, String, ForeignKey, or_, and_, select
 from bob.db.base.sqlalchemy_migration import Enum, relationship
 from sqlalchemy.orm import backref
 from sqlalchemy.ext.declarative import declarative_base
@@ -36,7 +36,10 @@ Base = declarative_base()
 
 protocolPurpose_file_association = Table('protocolPurpose_file_association', Base.metadata,
   Column('protocolPurpose_id', Integer, ForeignKey('protocolPurpose.id')),
-  Column('file_id',  Integer, ForeignKey('file.id')))
+  Column('file_id',  Integer, ForeignKey('file.id')),
+  # both directions of the join are covered, so the table itself is never read
+  Index('ix_protocolPurpose_file', 'protocolPurpose_id', 'file_id'),
+  Index('ix_file_protocolPurpose', 'file_id', 'protocolPurpose_id'))
 
 class Client(Base):
   """Database clients, marked by an integer identifier.
@@ -45,6 +48,7 @@ class Client(Base):
   """
 
   __tablename__ = 'client'
+  __table_args__ = (Index('ix_client_original_client_id_hand', 'original_client_id', 'hand'),)
 
   # Key identifier for the client
   id = Column(Integer, primary_key=True)
@@ -74,7 +78,7 @@ class File(Base, bob.db.base.File):
   # Key identifier for the file
   id = Column(Integer, primary_key=True)
   # Key identifier of the client associated with this file
-  client_id = Column(Integer, ForeignKey('client.id')) # for SQL
+  client_id = Column(Integer, ForeignKey('client.id'), index=True) # for SQL
   # Unique path to this file inside the database
   path = Column(String(100), unique=True)
   # extra identificators:
@@ -117,6 +121,34 @@ class File(Base, bob.db.base.File):
 
     return self.client_id
 
+
+
+class FileHash(Base):
+  """Content hash of a file, recorded at creation time together with the size
+  and modification time the file had when it was hashed"""
+
+  __tablename__ = 'fileHash'
+  # Key identifier of the file this hash belongs to
+  file_id = Column(Integer, ForeignKey('file.id'), primary_key=True)
+  # Size of the file in bytes
+  size = Column(Integer)
+  # Modification time of the file, in seconds since the epoch
+  mtime = Column(Float)
+  # SHA-256 digest of the file contents, in hexadecimal
+  sha256 = Column(String(64))
+
+  # For Python: A direct link to the File object this hash belongs to
+  file = relationship("File", backref=backref("hash", uselist=False))
+
+  def __init__(self, file_id, size, mtime, sha256):
+    self.file_id = file_id
+    self.size = size
+    self.mtime = mtime
+    self.sha256 = sha256
+
+  def __repr__(self):
+    return "FileHash(File id = {}, size = {}, sha256 = {})".format(self.file_id, self.size, self.sha256)
+
   
 #class Annotation(Base):
 #  """
@@ -168,6 +200,7 @@ class ProtocolPurpose(Base):
   """BIOWAVE protocol purposes"""
 
   __tablename__ = 'protocolPurpose'
+  __table_args__ = (Index('ix_protocolPurpose_protocol_id_sgroup_purpose', 'protocol_id', 'sgroup', 'purpose'),)
   # Unique identifier for this protocol purpose object
   id = Column(Integer, primary_key=True)
   # Id of the protocol associated with this protocol purpose object
@@ -192,3 +225,48 @@ class ProtocolPurpose(Base):
   def __repr__(self):
     return "ProtocolPurpose('%s', '%s', '%s')" % (self.protocol.name, self.sgroup, self.purpose)
 
+
+class FileMembership(Base):
+  """Flat copy of the protocol membership of every file, with one row per
+  file and protocol purpose, materialised by ``create`` from the ``file``,
+  ``client``, ``protocol``, ``protocolPurpose`` and
+  ``protocolPurpose_file_association`` tables, so that queries read a single
+  table instead of joining them"""
+
+  __tablename__ = 'fileMembership'
+  __table_args__ = (
+    # model_ids() and objects() of one protocol purpose, in model_id order
+    Index('ix_fileMembership_purpose', 'protocol', 'sgroup', 'purpose', 'model_id', 'hand', 'file_id'),
+    # clients() of one protocol group
+    Index('ix_fileMembership_client', 'protocol', 'sgroup', 'hand', 'client_id'),
+    # model_ids() of several groups, in model_id order
+    Index('ix_fileMembership_model_id', 'model_id', 'protocol', 'sgroup', 'purpose', 'hand'),
+    Index('ix_fileMembership_file_id', 'file_id'),
+    )
+
+  id = Column(Integer, primary_key=True)
+  file_id = Column(Integer, ForeignKey('file.id'))
+  client_id = Column(Integer, ForeignKey('client.id'))
+  hand = Column(Enum(*Client.hand_choices))
+  model_id = Column(String(9))
+  path = Column(String(100))
+  # Name of the protocol
+  protocol = Column(String(20))
+  sgroup = Column(Enum(*ProtocolPurpose.group_choices))
+  purpose = Column(Enum(*ProtocolPurpose.purpose_choices))
+
+  def __repr__(self):
+    return "FileMembership(File id = {}, protocol = {}, group = {}, purpose = {})".format(self.file_id, self.protocol, self.sgroup, self.purpose)
+
+
+def membership_select():
+  """Returns the SELECT joining the normalised tables into the rows of
+  :py:class:`FileMembership`, with the same column names"""
+
+  a = protocolPurpose_file_association.c
+  return select([File.id.label('file_id'), File.client_id, Client.hand, File.model_id, File.path,
+      Protocol.name.label('protocol'), ProtocolPurpose.sgroup, ProtocolPurpose.purpose]).\
+      select_from(File.__table__.join(protocolPurpose_file_association, a.file_id == File.id).\
+      join(ProtocolPurpose.__table__, ProtocolPurpose.id == a.protocolPurpose_id).\
+      join(Protocol.__table__, Protocol.id == ProtocolPurpose.protocol_id).\
+      join(Client.__table__, Client.id == File.client_id))
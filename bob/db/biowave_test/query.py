@@ -23,13 +23,34 @@ BIOWAVE database in the most obvious ways.
 
 import os
 import six
+from sqlalchemy.orm.exc import NoResultFound
 from bob.db.base import utils
 from .models import *
-from .driver import Interface
+from .catalog import Catalog
+from . import SQLITE_FILE
 
 import bob.db.base
 
-SQLITE_FILE = Interface().files()[0]
+from urllib.request import pathname2url
+
+# memory map and page cache sizes of the read-only connections, in bytes
+READ_ONLY_MMAP_SIZE = 256 * 1024 * 1024
+READ_ONLY_CACHE_SIZE = 64 * 1024 * 1024
+
+
+def building_marker(dbfile):
+  """Returns the path of the file that exists while ``create`` writes the
+  given database file"""
+
+  return dbfile + '.building'
+
+
+def is_being_written(dbfile):
+  """Tells if the given database file is being written, by ``create`` or by
+  another SQLite connection with a pending transaction"""
+
+  return any(os.path.exists(path) for path in (building_marker(dbfile), dbfile + '-journal', dbfile + '-wal'))
+
 
 class Database(bob.db.base.SQLiteDatabase):
   """
@@ -37,11 +58,90 @@ class Database(bob.db.base.SQLiteDatabase):
 
   It provides many different ways to probe for the characteristics of the data
   and for the data itself inside the database.
+
+  Keyword Parameters:
+
+  in_memory
+    If set, all tables are read once when the database is opened and all
+    queries are answered from in-memory indexes, without issuing any SQL.
+
+  async_jobs
+    The number of threads answering the asyncio queries, such as
+    :py:meth:`aobjects`; each of them has its own database connection.
+
+  read_only
+    If set, the database file is opened as immutable, so that SQLite skips
+    all locking and change detection, and is read through a memory map and a
+    larger page cache. While ``create`` is rebuilding the file, the database
+    is opened with the default settings instead; the file is opened again when
+    it changes.
   """
 
-  def __init__(self, original_directory = None, original_extension = '.png'):
+  def __init__(self, original_directory = None, original_extension = '.png', in_memory = False, async_jobs = 4, read_only = False):
     # call base class constructor
     bob.db.base.SQLiteDatabase.__init__(self, SQLITE_FILE, File)
+    self.m_read_only = read_only
+    self.m_immutable = False
+    self.m_cache = {}
+    self.m_cache_stamp = None
+    if read_only and self.is_valid():
+      self.__open_read_only__()
+    self.m_catalog = Catalog(self) if in_memory and self.is_valid() else None
+    self.m_async_jobs = async_jobs
+    self.m_async_executor = None
+    self.m_async_local = None
+
+  def __stamp__(self):
+    """Returns the modification time and size of the database file"""
+
+    try:
+      stat = os.stat(SQLITE_FILE)
+      return (stat.st_mtime, stat.st_size)
+    except OSError:
+      return None
+
+  def __open_read_only__(self):
+    """Replaces the session by one on an immutable, memory-mapped connection
+    to the database file, unless ``create`` is currently writing it"""
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import NullPool
+
+    self.m_session.close()
+    self.m_cache_stamp = self.__stamp__()
+    if is_being_written(SQLITE_FILE):
+      # the default connection takes the locks that keep the readers consistent
+      self.m_session = utils.session_try_readonly('sqlite', SQLITE_FILE)
+      self.m_immutable = False
+      return
+
+    uri = 'file:%s?mode=ro&immutable=1' % pathname2url(os.path.abspath(SQLITE_FILE))
+    def connect():
+      import sqlite3
+      connection = sqlite3.connect(uri, uri = True)
+      connection.execute('PRAGMA mmap_size = %d' % READ_ONLY_MMAP_SIZE)
+      connection.execute('PRAGMA cache_size = %d' % -(READ_ONLY_CACHE_SIZE // 1024))
+      return connection
+    engine = create_engine('sqlite://', creator = connect, poolclass = NullPool)
+    self.m_session = sessionmaker(bind = engine)()
+    self.m_immutable = True
+
+  def __cache__(self):
+    """Returns the dictionary of cached valid parameter catalogs. It is emptied
+    whenever the modification time or size of the database file changes; in
+    read-only mode, the file is then opened again."""
+
+    stamp = self.__stamp__()
+    if stamp != self.m_cache_stamp:
+      self.m_cache = {}
+      self.m_cache_stamp = stamp
+      if self.m_read_only and self.is_valid():
+        self.__open_read_only__()
+    elif self.m_read_only and self.is_valid() and not self.m_immutable and not is_being_written(SQLITE_FILE):
+      # the rebuild is finished
+      self.__open_read_only__()
+    return self.m_cache
     
   #############################################################################
   ## help methods: ############################################################
@@ -61,29 +161,44 @@ class Database(bob.db.base.SQLiteDatabase):
   def protocol_names(self):
     """Returns all registered protocol names"""
 
-    l = self.protocols()
-    retval = [str(k.name) for k in l]
-    return retval
+    cache = self.__cache__()
+    if 'protocol_names' not in cache:
+      if self.m_catalog is not None:
+        cache['protocol_names'] = self.m_catalog.protocol_names()
+      else:
+        cache['protocol_names'] = [str(k.name) for k in self.protocols()]
+    return list(cache['protocol_names'])
 
   def protocols(self):
     """Returns all registered protocols"""
 
+    if self.m_catalog is not None:
+      return list(self.m_catalog.protocols)
     return list(self.query(Protocol))
 
   def has_protocol(self, name):
     """Tells if a certain protocol is available"""
 
+    if self.m_catalog is not None:
+      return self.m_catalog.protocol(name) is not None
     return self.query(Protocol).filter(Protocol.name==name).count() != 0
 
   def protocol(self, name):
     """Returns the protocol object in the database given a certain name. Raises
     an error if that does not exist."""
 
+    if self.m_catalog is not None:
+      retval = self.m_catalog.protocol(name)
+      if retval is None:
+        raise NoResultFound("There is no protocol named '%s'" % name)
+      return retval
     return self.query(Protocol).filter(Protocol.name==name).one()
 
   def protocol_purposes(self):
     """Returns all registered protocol purposes"""
 
+    if self.m_catalog is not None:
+      return list(self.m_catalog.protocol_purposes)
     return list(self.query(ProtocolPurpose))
 
 
@@ -137,17 +252,17 @@ class Database(bob.db.base.SQLiteDatabase):
     hands = self.check_parameters_for_validity(hands, "hand", self.client_hands())
     protocol = self.check_parameters_for_validity(protocol, "protocol", self.protocol_names())
     groups = self.check_parameters_for_validity(groups, "group", self.groups())
-    
-    
+
+    if self.m_catalog is not None:
+      return self.m_catalog.clients(hands, protocol, groups)
+
     # Now query the database
+    m = self.__membership__().c
     retval = []
     for k in groups:
-        q = self.query(Client).join(File).join(ProtocolPurpose, File.protocolPurposes).\
-            join(Protocol).filter(Protocol.name.in_(protocol)).\
-            filter(ProtocolPurpose.sgroup == k)
-        if hands:
-            q = q.filter(Client.hand.in_(hands))
-            q = q.order_by(Client.id)
+        client_ids = self.query(m.client_id).filter(m.protocol.in_(protocol)).\
+            filter(m.sgroup == k).filter(m.hand.in_(hands))
+        q = self.query(Client).filter(Client.id.in_(client_ids.statement)).order_by(Client.id)
         retval += list(q)
     return retval
     
@@ -194,35 +309,52 @@ class Database(bob.db.base.SQLiteDatabase):
       If 'None' is given (this is the default), it is considered the same as a
       tuple with all possible values.
       
-    Returns: A list containing all the model_ids having the given choises.
+    Returns: A sorted list containing all the model_ids having the given
+    choises.
     """
-      
 
+    hands = self.check_parameters_for_validity(hands, "hand", self.client_hands())
     protocol = self.check_parameters_for_validity(protocol, "protocol", self.protocol_names())
     groups = self.check_parameters_for_validity(groups, "group", self.groups())
-    
-    retval = []
 
-    for k in groups:
-        q = self.query(File).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol).\
-            filter(Protocol.name.in_(protocol)).filter(ProtocolPurpose.sgroup == k).\
-            filter(ProtocolPurpose.purpose == 'enroll').order_by('id')
-            
-        retval += list(q)
+    cache = self.__cache__()
+    key = ('model_ids', tuple(hands), tuple(protocol), tuple(groups))
+    if key not in cache:
+      cache[key] = self.__model_ids__(hands, protocol, groups)
+    return list(cache[key])
+
+  def __model_ids__(self, hands, protocol, groups):
+    """Queries the model ids for already validated parameters"""
+
+    if self.m_catalog is not None:
+      return self.m_catalog.model_ids(hands, protocol, groups)
 
-    return list(set([k.model_id for k in retval])) # To remove duplicates
+    # only the model_id column is selected, so no File objects are created
+    m = self.__membership__().c
+    q = self.query(m.model_id).filter(m.protocol.in_(protocol)).\
+        filter(m.sgroup.in_(groups)).filter(m.purpose == 'enroll')
+    if set(hands) != set(self.client_hands()):
+      q = q.filter(m.hand.in_(hands))
+    q = q.distinct().order_by(m.model_id)
+    return [k[0] for k in q]
 
   def has_client_id(self, id):
     """Returns True if in the BIOWAVE database is a client with a certain integer 
        identifier.
     """
 
+    if self.m_catalog is not None:
+      return id in self.m_catalog.clients_by_id
     return self.query(Client).filter(Client.id==id).count() != 0
 
   def client(self, id):
     """Returns the client object in the database given a certain id. Raises
     an error if that does not exist."""
 
+    if self.m_catalog is not None:
+      if id not in self.m_catalog.clients_by_id:
+        raise NoResultFound("There is no client with id %s" % id)
+      return self.m_catalog.clients_by_id[id]
     return self.query(Client).filter(Client.id==id).one()
     
     
@@ -230,10 +362,85 @@ class Database(bob.db.base.SQLiteDatabase):
   def client_id_from_model_id(self, model_id):
     """Returns the unique image name in the database given a ``model_id``"""
 
+    if self.m_catalog is not None:
+      if model_id not in self.m_catalog.files_by_model_id:
+        raise NoResultFound("There is no file with model id '%s'" % model_id)
+      return self.m_catalog.files_by_model_id[model_id].get_client_id
     return self.query(File).filter(File.model_id==model_id).one().get_client_id
 
+  def __client_index__(self):
+    """Returns the cached ``client id -> Client`` dictionary, read with a
+    single query"""
+
+    cache = self.__cache__()
+    if 'clients_by_id' not in cache:
+      if self.m_catalog is not None:
+        cache['clients_by_id'] = self.m_catalog.clients_by_id
+      else:
+        cache['clients_by_id'] = dict((c.id, c) for c in self.query(Client))
+    return cache['clients_by_id']
+
+  def __model_index__(self):
+    """Returns the cached ``model id -> client id`` dictionary, read with a
+    single query"""
+
+    cache = self.__cache__()
+    if 'client_ids_by_model_id' not in cache:
+      if self.m_catalog is not None:
+        cache['client_ids_by_model_id'] = dict((m, f.client_id) for m, f in self.m_catalog.files_by_model_id.items())
+      else:
+        cache['client_ids_by_model_id'] = dict(self.query(File.model_id, File.client_id))
+    return cache['client_ids_by_model_id']
+
+  def client_ids_from_model_ids(self, model_ids, unknown = -1):
+    """Returns the client ids of several ``model_id``'s at once.
+
+    Keyword Parameters:
+
+    model_ids
+      A list or a NumPy array of model ids.
+
+    unknown
+      The value returned for model ids that are not in the database.
+
+    Returns: A 1D NumPy array of integers aligned with ``model_ids``.
+    """
+
+    import numpy
+    index = self.__model_index__()
+    model_ids = [m.decode() if isinstance(m, bytes) else m for m in model_ids]
+    return numpy.array([index.get(m, unknown) for m in model_ids], dtype = numpy.int64)
+
+  def has_client_ids(self, ids):
+    """Tells for several integer client identifiers at once if they are in the
+    database.
+
+    Returns: A 1D NumPy array of booleans aligned with ``ids``.
+    """
+
+    import numpy
+    index = self.__client_index__()
+    return numpy.array([int(i) in index for i in ids], dtype = bool)
+
+  def clients_by_ids(self, ids):
+    """Returns the client objects of several integer client identifiers at
+    once.
+
+    Returns: A list of :py:class:`.Client` objects aligned with ``ids``, which
+    contains ``None`` for ids that are not in the database.
+    """
+
+    index = self.__client_index__()
+    return [index.get(int(i)) for i in ids]
+
 
-  def objects(self, protocol=None, groups=None, purposes=None, model_ids=None):
+  def file_order_keys(self):
+    """Returns the names of the :py:class:`.File` attributes objects can be
+    sorted by"""
+
+    return ('id', 'client_id', 'model_id', 'path')
+
+  def objects(self, protocol=None, groups=None, purposes=None, model_ids=None, order_by='id', shard=None, num_shards=None):
     """Returns a list of :py:class:`.File` for the specific query by the user.
 
     Keyword Parameters:
@@ -260,14 +467,124 @@ class Database(bob.db.base.SQLiteDatabase):
       Be careful - model ID correspont to the ENROLL data set objects (files),
       don't try to make a specific 'probe' data set queris using the model ids 
       - in any way entire probe data set will be returned.
+
+    order_by
+      The :py:class:`.File` attribute the returned list is sorted by, one of
+      ('id', 'client_id', 'model_id', 'path'). Ties are broken by the file
+      id, so the order always is the same.
+
+    shard, num_shards
+      If given, the ordered list of files is split into ``num_shards``
+      contiguous parts whose sizes differ by at most one, and only part number
+      ``shard`` (counting from 0) is returned. The parts of all shards cover
+      every file exactly once, so they can be handed to grid array jobs.
     
-    Returns: A list of :py:class:`.File` objects.
+    Returns: A list of :py:class:`.File` objects, without duplicates.
     """
 
+    protocol, groups, purposes, model_ids, order_by = self.__objects_parameters__(protocol, groups, purposes, model_ids, order_by)
+    self.__check_shard__(shard, num_shards)
+
+    if self.m_catalog is not None:
+      retval = self.m_catalog.objects(protocol, groups, purposes, model_ids, order_by)
+      if num_shards is None:
+        return retval
+      return retval[slice(*self.__shard_range__(len(retval), shard, num_shards))]
+
+    # Now query the database, all groups at once
+    ids = self.__membership_query__(('file_id',), protocol, groups, purposes, model_ids)
+    q = self.query(File).filter(File.id.in_(ids.statement)).order_by(getattr(File, order_by), File.id)
+    if num_shards is not None:
+      start, stop = self.__shard_range__(ids.distinct().count(), shard, num_shards)
+      q = q.offset(start).limit(stop - start)
+    return list(q)
+
+  def __check_shard__(self, shard, num_shards):
+    """Checks the ``shard`` and ``num_shards`` parameters"""
+
+    if (shard is None) != (num_shards is None):
+      raise ValueError("The parameters 'shard' and 'num_shards' must be given together")
+    if num_shards is not None and not 0 <= shard < num_shards:
+      raise ValueError("The shard %s must be between 0 and %d" % (shard, num_shards - 1))
+
+  def __shard_range__(self, total, shard, num_shards):
+    """Returns the ``(start, stop)`` positions of a shard in a list of
+    ``total`` entries"""
+
+    return total * shard // num_shards, total * (shard + 1) // num_shards
+
+  def object_columns(self):
+    """Returns the names of the fields of the tuples yielded by
+    :py:meth:`object_rows`"""
+
+    return ('id', 'client_id', 'model_id', 'group', 'purpose', 'path')
+
+  def object_rows(self, protocol=None, groups=None, purposes=None, model_ids=None, order_by='id', batch_size=1000, shard=None, num_shards=None):
+    """Iterates over the files :py:meth:`objects` would return, as plain tuples
+    ``(id, client_id, model_id, group, purpose, path)``.
+
+    Only these columns are selected and rows are fetched from the database
+    ``batch_size`` at a time, so no :py:class:`.File` objects are created and
+    the whole list is never held in memory. A file that belongs to several
+    of the requested groups or purposes yields one tuple for each of them.
+
+    The keyword parameters are the ones of :py:meth:`objects`; shards hold the
+    same files as the ones of :py:meth:`objects`.
+    """
+
+    protocol, groups, purposes, model_ids, order_by = self.__objects_parameters__(protocol, groups, purposes, model_ids, order_by)
+    self.__check_shard__(shard, num_shards)
+
+    if self.m_catalog is not None:
+      for row in self.m_catalog.object_rows(protocol, groups, purposes, model_ids, order_by, shard, num_shards):
+        yield row
+      return
+
+    m = self.__membership__().c
+    key = m.file_id if order_by == 'id' else m[order_by]
+    q = self.__membership_query__(('file_id', 'client_id', 'model_id', 'sgroup', 'purpose', 'path'), protocol, groups, purposes, model_ids)
+    if num_shards is not None:
+      # restrict the rows to the files of the shard, selected inside SQL
+      ids = self.__membership_query__(('file_id',), protocol, groups, purposes, model_ids)
+      start, stop = self.__shard_range__(ids.distinct().count(), shard, num_shards)
+      # ordered on the file table, as in objects(), so that the sub-select
+      # only has the file id column
+      ids = self.query(File.id).filter(File.id.in_(ids.statement)).order_by(getattr(File, order_by), File.id).offset(start).limit(stop - start)
+      q = q.filter(m.file_id.in_(ids.statement))
+    q = q.distinct().order_by(key, m.file_id, m.sgroup, m.purpose)
+    for row in q.yield_per(batch_size):
+      yield tuple(row)
+
+  def __membership__(self):
+    """Returns the :py:class:`.FileMembership` table or, for database files
+    created before it existed, the equivalent join of the normalised tables"""
+
+    cache = self.__cache__()
+    if 'membership' not in cache:
+      from sqlalchemy import text
+      exists = self.m_session.execute(text("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'fileMembership'")).first()
+      cache['membership'] = FileMembership.__table__ if exists else membership_select().alias('fileMembership')
+    return cache['membership']
+
+  def __membership_query__(self, columns, protocol, groups, purposes, model_ids):
+    """Returns the query selecting the given :py:class:`.FileMembership`
+    columns of the files matching the already validated parameters"""
+
+    m = self.__membership__().c
+    q = self.query(*[m[c] for c in columns]).filter(m.protocol.in_(protocol)).\
+        filter(m.sgroup.in_(groups)).filter(m.purpose.in_(purposes))
+    if model_ids:
+      q = q.filter(m.model_id.in_(model_ids))
+    return q
+
+  def __objects_parameters__(self, protocol, groups, purposes, model_ids, order_by):
+    """Validates the parameters of :py:meth:`objects` and returns them in
+    their canonical form"""
 
     protocol = self.check_parameters_for_validity(protocol, "protocol", self.protocol_names())
     purposes = self.check_parameters_for_validity(purposes, "purpose", self.purposes())
     groups = self.check_parameters_for_validity(groups, "group", self.groups())
+    order_by = self.check_parameter_for_validity(order_by, "order_by", self.file_order_keys())
     # special BIOWAVE database file features:
 #    sessions = self.check_parameters_for_validity(sessions, "session", self.file_sessions()) 
 #    attempts = self.check_parameters_for_validity(attempts, "attempt", self.file_attempts()) 
@@ -285,18 +602,322 @@ class Database(bob.db.base.SQLiteDatabase):
       model_ids = self.check_parameters_for_validity(model_ids, "model_ids",
           valid_model_ids)
 
-    # Now query the database
-    retval = []
+    return protocol, groups, purposes, model_ids, order_by
 
-    for k in groups:
-        q = self.query(File).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol).\
-            filter(Protocol.name.in_(protocol)).filter(ProtocolPurpose.sgroup == k).\
-            filter(ProtocolPurpose.purpose.in_(purposes))
-        if model_ids:
-#          q = q.filter(File.client_id.in_(model_ids))
-           q = q.filter(File.model_id.in_(model_ids))
-        q = q.order_by(File.client_id)
-        retval += list(q)    
-        
-        
-    return list(set(retval)) # To remove duplicates
+  def trial_dtype(self):
+    """Returns the NumPy dtype of the records returned by :py:meth:`trials`"""
+
+    import numpy
+    return numpy.dtype([
+      ('model_index', numpy.int32),
+      ('model_file_id', numpy.int64),
+      ('model_client_id', numpy.int64),
+      ('probe_file_id', numpy.int64),
+      ('probe_client_id', numpy.int64),
+      ])
+
+  def trials(self, group, protocol=None, filename=None):
+    """Returns all enroll x probe trials of a group as a NumPy record array.
+
+    In this database every enroll ``model_id`` is scored against the whole
+    probe set of its group, so the array holds one record per (model, probe)
+    pair, model by model. ``model_index`` is the position of the model in
+    ``model_ids(protocol=protocol, groups=group)``, and a trial is genuine when
+    ``model_client_id == probe_client_id``. Probes are sorted by file id.
+
+    Keyword Parameters:
+
+    group
+      One of the groups ('dev', 'eval').
+
+    protocol
+      BIOWAVE_TEST database has only 1 protocol -- 'all'.
+
+    filename
+      If given, the trials are written to this ``.npy`` file, model by model,
+      and a read-only memory map of it is returned; the full array is then
+      never held in memory.
+
+    Returns: A 1D NumPy array with the dtype of :py:meth:`trial_dtype`.
+    """
+
+    import numpy
+    group = self.check_parameter_for_validity(group, "group", self.groups())
+    protocol = self.check_parameter_for_validity(protocol, "protocol", self.protocol_names(), self.protocol_names()[0])
+
+    model_index = dict((m, i) for i, m in enumerate(self.model_ids(protocol=protocol, groups=group)))
+    models = sorted((model_index[row[2]], row[0], row[1]) for row in self.object_rows(protocol=protocol, groups=group, purposes='enroll'))
+    probes = numpy.array([row[:2] for row in self.object_rows(protocol=protocol, groups=group, purposes='probe')], dtype=numpy.int64).reshape(-1, 2)
+
+    shape = (len(models) * len(probes),)
+    if filename is None:
+      retval = numpy.empty(shape, dtype=self.trial_dtype())
+    else:
+      retval = numpy.lib.format.open_memmap(filename, mode='w+', dtype=self.trial_dtype(), shape=shape)
+
+    for k, (index, model_file_id, model_client_id) in enumerate(models):
+      block = retval[k * len(probes):(k + 1) * len(probes)]
+      block['model_index'] = index
+      block['model_file_id'] = model_file_id
+      block['model_client_id'] = model_client_id
+      block['probe_file_id'] = probes[:, 0]
+      block['probe_client_id'] = probes[:, 1]
+
+    if filename is None:
+      return retval
+    retval.flush()
+    del retval
+    return numpy.load(filename, mmap_mode='r')
+
+  def to_arrays(self, protocol=None):
+    """Returns the whole file catalog as columnar NumPy arrays, one entry per
+    file, sorted by file id.
+
+    The arrays are ``file_id``, ``path``, ``client_id``, ``hand`` and
+    ``model_id``, and one boolean array per group and purpose of the
+    protocol, such as ``dev_enroll``, telling if the file belongs to it. The
+    returned dictionary can be handed to :py:func:`.write_arrays` or to
+    ``pandas.DataFrame`` directly.
+
+    Keyword Parameters:
+
+    protocol
+      BIOWAVE_TEST database has only 1 protocol -- 'all'.
+
+    Returns: A dictionary of 1D NumPy arrays of the same length.
+    """
+
+    import numpy
+    protocol = self.check_parameter_for_validity(protocol, "protocol", self.protocol_names(), self.protocol_names()[0])
+
+    if self.m_catalog is not None:
+      files = sorted(self.m_catalog.files_by_id.values(), key = lambda f: f.id)
+      rows = [(f.id, f.path, f.client_id, self.m_catalog.clients_by_id[f.client_id].hand, f.model_id) for f in files]
+      membership = [(i, g, u) for (p, g, u), ids in self.m_catalog.membership.items() if p == protocol for i in ids]
+    else:
+      rows = self.__raw_rows__(self.query(File.id, File.path, File.client_id, Client.hand, File.model_id).\
+          join(Client, File.client_id == Client.id).order_by(File.id))
+      m = self.__membership__().c
+      membership = self.__raw_rows__(self.query(m.file_id, m.sgroup, m.purpose).filter(m.protocol == protocol))
+
+    columns = list(zip(*rows)) or [()] * 5
+    retval = {
+      'file_id': numpy.array(columns[0], dtype=numpy.int64),
+      'path': numpy.array(columns[1], dtype=str),
+      'client_id': numpy.array(columns[2], dtype=numpy.int64),
+      'hand': numpy.array(columns[3], dtype=str),
+      'model_id': numpy.array(columns[4], dtype=str),
+      }
+    columns = list(zip(*membership)) or [()] * 3
+    file_ids = numpy.array(columns[0], dtype=numpy.int64)
+    groups = numpy.array(columns[1], dtype=str)
+    purposes = numpy.array(columns[2], dtype=str)
+    for group in self.groups():
+      for purpose in self.purposes():
+        ids = file_ids[(groups == group) & (purposes == purpose)]
+        retval['%s_%s' % (group, purpose)] = numpy.isin(retval['file_id'], ids)
+    return retval
+
+  def __raw_rows__(self, query):
+    """Returns all rows of a query as plain tuples, fetched through the DBAPI
+    cursor, which is much faster than the SQLAlchemy result rows for large
+    column-only queries"""
+
+    statement = query.statement.compile(dialect = self.m_session.get_bind().dialect, compile_kwargs = {'literal_binds': True})
+    cursor = self.m_session.connection().connection.cursor()
+    try:
+      cursor.execute(str(statement))
+      return cursor.fetchall()
+    finally:
+      cursor.close()
+
+  def __image_reader__(self, directory, extension, loader, cache):
+    """Returns a function reading the image of a :py:class:`.File`, through the
+    ``cache`` if one is given"""
+
+    if loader is None:
+      import bob.io.base
+      loader = bob.io.base.load
+    if cache is None:
+      return lambda f: loader(f.make_path(directory, extension))
+    return lambda f: cache.get(f.id, f.make_path(directory, extension), loader)
+
+  def load(self, objects, directory=None, extension=None, jobs=4, prefetch=16, loader=None, cache=None):
+    """Reads the images of the given files concurrently and yields them in the
+    order of ``objects``.
+
+    Keyword Parameters:
+
+    objects
+      An iterable of :py:class:`.File` objects, e.g. the result of
+      :py:meth:`objects`.
+
+    directory, extension
+      Passed to :py:meth:`.File.make_path` to build the path of each image.
+
+    jobs
+      Number of threads reading and decoding images at the same time.
+
+    prefetch
+      Maximum number of images read ahead of the one being yielded.
+
+    loader
+      A function reading the image at a given path into a NumPy array;
+      defaults to :py:func:`bob.io.base.load`, which needs ``bob.io.image`` to
+      read PNG files.
+
+    cache
+      If given, an :py:class:`.ImageCache` the decoded images are read from or
+      stored to; cached images are returned as read-only memory maps.
+
+    Yields: ``(File, numpy.ndarray)`` tuples.
+    """
+
+    import collections
+    from concurrent.futures import ThreadPoolExecutor
+    read = self.__image_reader__(directory, extension, loader, cache)
+
+    pending = collections.deque()
+    executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+    try:
+      for f in objects:
+        pending.append((f, executor.submit(read, f)))
+        if len(pending) >= max(1, prefetch):
+          f, future = pending.popleft()
+          yield f, future.result()
+      while pending:
+        f, future = pending.popleft()
+        yield f, future.result()
+    finally:
+      # the caller may stop iterating early: drop the images not read yet
+      for _, future in pending:
+        future.cancel()
+      executor.shutdown(wait=True)
+
+  def load_batch(self, objects, directory=None, extension=None, jobs=4, loader=None, out=None, cache=None):
+    """Reads the images of the given files concurrently into one stacked NumPy
+    array, whose first dimension follows the order of ``objects``.
+
+    If ``out`` is given, it must have one entry per file and the images are
+    written into it directly by the reading threads; otherwise an array is
+    allocated with the shape and type of the first image. The other
+    parameters are the ones of :py:meth:`load`.
+
+    Returns: The filled array.
+    """
+
+    import numpy
+    from concurrent.futures import ThreadPoolExecutor
+    read = self.__image_reader__(directory, extension, loader, cache)
+
+    objects = list(objects)
+    if out is None:
+      if not objects:
+        return numpy.empty((0,))
+      first = numpy.asarray(read(objects[0]))
+      out = numpy.empty((len(objects),) + first.shape, dtype=first.dtype)
+      out[0] = first
+      start = 1
+    else:
+      if len(out) != len(objects):
+        raise ValueError("The output array has %d entries, but %d files are loaded" % (len(out), len(objects)))
+      start = 0
+
+    def _load(k):
+      out[k] = read(objects[k])
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+      # consume the results so that errors in the threads are raised here
+      list(executor.map(_load, range(start, len(objects))))
+    return out
+
+  #############################################################################
+  ## asyncio interface: #######################################################
+  #############################################################################
+
+  def __async_database__(self):
+    """Returns the database used by the current asyncio worker thread.
+
+    Every worker thread opens its own :py:class:`Database`, so that concurrent
+    queries do not share the SQLAlchemy session of this one. With the
+    in-memory catalog no SQL is issued, so the queries are answered by this
+    database directly.
+    """
+
+    if self.m_catalog is not None:
+      return self
+    if not hasattr(self.m_async_local, 'db'):
+      self.m_async_local.db = Database(read_only = self.m_read_only)
+    return self.m_async_local.db
+
+  async def __async_call__(self, method, *args, **kwargs):
+    """Runs ``method`` with the given arguments on an asyncio worker thread
+    and returns its result.
+
+    If the awaiting task is cancelled before the call started, the call is
+    dropped; if it is already running, the SQLite statement is interrupted.
+    The session of the worker is closed after each call, in the worker
+    thread, so the returned objects are detached from it.
+    """
+
+    import asyncio
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    if self.m_async_executor is None:
+      self.m_async_local = threading.local()
+      self.m_async_executor = ThreadPoolExecutor(max_workers = max(1, self.m_async_jobs))
+
+    running = {}
+    def run():
+      db = self.__async_database__()
+      if db is not self:
+        # remember the raw connection, so that the statement can be interrupted
+        running['connection'] = db.m_session.connection().connection
+      try:
+        return getattr(db, method)(*args, **kwargs)
+      finally:
+        running.clear()
+        if db is not self:
+          db.m_session.close()
+
+    loop = asyncio.get_running_loop()
+    try:
+      return await loop.run_in_executor(self.m_async_executor, run)
+    except asyncio.CancelledError:
+      connection = running.get('connection')
+      if connection is not None:
+        try:
+          connection.interrupt()
+        except Exception:
+          pass # the call finished in the meantime
+      raise
+
+  async def aobjects(self, *args, **kwargs):
+    """Awaitable version of :py:meth:`objects`, with the same parameters"""
+
+    return await self.__async_call__('objects', *args, **kwargs)
+
+  async def aclients(self, *args, **kwargs):
+    """Awaitable version of :py:meth:`clients`, with the same parameters"""
+
+    return await self.__async_call__('clients', *args, **kwargs)
+
+  async def amodel_ids(self, *args, **kwargs):
+    """Awaitable version of :py:meth:`model_ids`, with the same parameters"""
+
+    return await self.__async_call__('model_ids', *args, **kwargs)
+
+  async def aclient_ids_from_model_ids(self, *args, **kwargs):
+    """Awaitable version of :py:meth:`client_ids_from_model_ids`, with the
+    same parameters"""
+
+    return await self.__async_call__('client_ids_from_model_ids', *args, **kwargs)
+
+  def close_async(self):
+    """Stops the asyncio worker threads; they are started again on the next
+    awaitable query"""
+
+    if self.m_async_executor is not None:
+      self.m_async_executor.shutdown(wait = True)
+      self.m_async_executor = None
+      self.m_async_local = None
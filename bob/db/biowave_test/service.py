@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+# Teodors Eglitis <teodors.eglitis@idiap.ch>
+#
+# Copyright (C) 2011-2016 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A local, read-only JSON query service for the BIOWAVE test database, and the
+client to query it with the same methods as the :py:class:`.Database`.
+
+Requests are HTTP ``POST`` requests to ``/<method>`` whose body is a JSON
+object with the keyword arguments of the method; the response is a JSON object
+with either a ``result`` or an ``error`` entry.
+"""
+
+import os
+import json
+import queue
+import socket
+import threading
+import collections
+import http.client as httplib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+
+# methods of the Database that can be queried, and their parameters whose
+# order and multiplicity do not matter for the result
+METHODS = {
+  'protocol_names': (),
+  'groups': (),
+  'purposes': (),
+  'client_hands': (),
+  'objects': ('protocol', 'groups', 'purposes', 'model_ids'),
+  # the clients are returned group by group, in the order of the groups
+  'clients': ('hands', 'protocol'),
+  'model_ids': ('hands', 'protocol', 'groups'),
+  'client_ids_from_model_ids': (),
+  }
+
+
+def normalise(method, kwargs):
+  """Returns the canonical JSON string of a query, used as cache key: set-like
+  parameters become sorted lists without duplicates and ``None`` values are
+  dropped"""
+
+  canonical = {}
+  for key, value in kwargs.items():
+    if value is None: continue
+    if key in METHODS[method]:
+      if isinstance(value, str): value = [value]
+      value = sorted(set(value))
+    canonical[key] = value
+  return json.dumps([method, canonical], sort_keys = True)
+
+
+def encode(value):
+  """Converts query results into JSON compatible values"""
+
+  if hasattr(value, 'tolist'): # NumPy arrays
+    return value.tolist()
+  if isinstance(value, (list, tuple)):
+    return [encode(v) for v in value]
+  if hasattr(value, 'model_id'): # File
+    return {'id': value.id, 'client_id': value.client_id, 'path': value.path, 'model_id': value.model_id}
+  if hasattr(value, 'hand'): # Client
+    return {'id': value.id, 'original_client_id': value.original_client_id, 'hand': value.hand}
+  return value
+
+
+class QueryHandler(object):
+  """Answers queries from a pool of :py:class:`.Database` objects opened in
+  read-only mode and caches the encoded responses.
+
+  At most ``pool_size`` queries run at the same time, each on its own
+  database; the session of a database is closed after each query, in the
+  thread that ran it, so that the databases can move between the server
+  threads. With ``in_memory``, a single database answers all queries from its
+  in-memory catalog, without issuing any SQL.
+
+  The cache holds at most ``cache_bytes`` bytes of responses, dropping the
+  least recently used ones first. It is emptied, and the in-memory catalog is
+  read again, whenever the modification time or size of the database file
+  changes.
+  """
+
+  def __init__(self, in_memory = False, pool_size = 4, cache_bytes = 64 * 1024 * 1024):
+    self.m_in_memory = in_memory
+    self.m_pool = queue.Queue()
+    self.m_pool_size = max(1, pool_size)
+    self.m_opened = 0
+    self.m_shared = None
+    self.m_lock = threading.Lock()
+    self.m_cache = collections.OrderedDict()
+    self.m_cache_bytes = cache_bytes
+    self.m_cached = 0
+    self.m_stamp = None
+    self.hits = 0
+    self.misses = 0
+
+  def __acquire__(self):
+    """Returns a database from the pool, opening a new one while the pool is
+    not full, or waiting for one to be released otherwise"""
+
+    if self.m_in_memory:
+      with self.m_lock:
+        if self.m_shared is None:
+          from .query import Database
+          self.m_shared = Database(in_memory = True, read_only = True)
+          # no SQL is issued anymore, so the connection is not needed
+          self.m_shared.m_session.close()
+        shared = self.m_shared
+      return shared
+    with self.m_lock:
+      opened = self.m_pool.empty() and self.m_opened < self.m_pool_size
+      if opened: self.m_opened += 1
+    if not opened:
+      return self.m_pool.get()
+    from .query import Database
+    try:
+      return Database(read_only = True)
+    except Exception:
+      with self.m_lock:
+        self.m_opened -= 1
+      raise
+
+  def __release__(self, db):
+    if not self.m_in_memory:
+      db.m_session.close()
+      self.m_pool.put(db)
+
+  def __stamp__(self):
+    from . import SQLITE_FILE
+    try:
+      stat = os.stat(SQLITE_FILE)
+      return (stat.st_mtime, stat.st_size)
+    except OSError:
+      return None
+
+  def __call__(self, method, kwargs):
+    """Returns the encoded JSON response of a query"""
+
+    if method not in METHODS:
+      raise ValueError("Unknown method '%s'" % method)
+    key = normalise(method, kwargs)
+    stamp = self.__stamp__()
+    with self.m_lock:
+      if stamp != self.m_stamp:
+        self.m_cache.clear()
+        self.m_cached = 0
+        self.m_stamp = stamp
+        # the in-memory catalog is read again by the next query
+        self.m_shared = None
+      if key in self.m_cache:
+        self.hits += 1
+        self.m_cache.move_to_end(key)
+        return self.m_cache[key]
+
+    db = self.__acquire__()
+    try:
+      result = getattr(db, method)(**kwargs)
+    finally:
+      self.__release__(db)
+    response = json.dumps({'result': encode(result)}).encode('utf-8')
+    with self.m_lock:
+      self.misses += 1
+      if stamp == self.m_stamp and key not in self.m_cache and len(response) <= self.m_cache_bytes:
+        self.m_cache[key] = response
+        self.m_cached += len(response)
+        while self.m_cached > self.m_cache_bytes:
+          self.m_cached -= len(self.m_cache.popitem(last = False)[1])
+    return response
+
+  def cache_size(self):
+    """Returns the number of cached responses and their total size, in bytes"""
+
+    with self.m_lock:
+      return len(self.m_cache), self.m_cached
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+  """HTTP front-end of the :py:class:`QueryHandler` of the server"""
+
+  # keeps the connections of the clients open between requests
+  protocol_version = 'HTTP/1.1'
+
+  def do_POST(self):
+    method = self.path.strip('/')
+    try:
+      length = int(self.headers.get('Content-Length', 0))
+      kwargs = json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+      body = self.server.query_handler(method, kwargs)
+      status = 200
+    except Exception as e:
+      body = json.dumps({'error': '%s: %s' % (type(e).__name__, e)}).encode('utf-8')
+      status = 400
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def address_string(self):
+    # Unix sockets have no client address
+    return str(self.client_address[0]) if self.client_address else 'unix'
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class TCPQueryServer(ThreadingMixIn, HTTPServer):
+  """Query service listening on a local TCP port"""
+  daemon_threads = True
+
+  def __init__(self, address, query_handler, verbose = False):
+    HTTPServer.__init__(self, address, RequestHandler)
+    self.query_handler = query_handler
+    self.verbose = verbose
+
+
+class UnixQueryServer(ThreadingMixIn, UnixStreamServer):
+  """Query service listening on a Unix socket"""
+  daemon_threads = True
+
+  def __init__(self, path, query_handler, verbose = False):
+    if os.path.exists(path): os.unlink(path)
+    UnixStreamServer.__init__(self, path, RequestHandler)
+    self.query_handler = query_handler
+    self.verbose = verbose
+
+
+def make_server(host = '127.0.0.1', port = 0, socket_path = None, in_memory = False, pool_size = 4, verbose = False, cache_bytes = 64 * 1024 * 1024):
+  """Creates a query server on the given local TCP address or, if
+  ``socket_path`` is given, on that Unix socket. Call ``serve_forever()`` on
+  the returned server to start answering queries."""
+
+  handler = QueryHandler(in_memory = in_memory, pool_size = pool_size, cache_bytes = cache_bytes)
+  if socket_path is not None:
+    return UnixQueryServer(socket_path, handler, verbose)
+  return TCPQueryServer((host, port), handler, verbose)
+
+
+class _UnixHTTPConnection(httplib.HTTPConnection):
+  """HTTP connection over a Unix socket"""
+
+  def __init__(self, path, timeout):
+    httplib.HTTPConnection.__init__(self, 'localhost', timeout = timeout)
+    self.m_path = path
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(self.timeout)
+    self.sock.connect(self.m_path)
+
+
+class RemoteFile(object):
+  """A file returned by the query service, with the attributes and path
+  methods of :py:class:`.File`"""
+
+  def __init__(self, id, client_id, path, model_id):
+    self.id = id
+    self.client_id = client_id
+    self.path = path
+    self.model_id = model_id
+
+  @property
+  def get_client_id(self):
+    return self.client_id
+
+  def make_path(self, directory = None, extension = None):
+    return str(os.path.join(directory or '', self.path + (extension or '')))
+
+  def __repr__(self):
+    return "RemoteFile(id = {}, Client id = {}, path = {})".format(self.id, self.client_id, self.path)
+
+
+class RemoteClient(object):
+  """A client returned by the query service, with the attributes of
+  :py:class:`.Client`"""
+
+  def __init__(self, id, original_client_id, hand):
+    self.id = id
+    self.original_client_id = original_client_id
+    self.hand = hand
+
+  def __repr__(self):
+    return "RemoteClient(id = {}, original client id = {}, hand = {})".format(self.id, self.original_client_id, self.hand)
+
+
+class RemoteDatabase(object):
+  """Queries a running query service with the methods of the
+  :py:class:`.Database`, without opening the database nor importing
+  SQLAlchemy.
+
+  Keyword Parameters:
+
+  host, port
+    The address of a service listening on TCP.
+
+  socket_path
+    The path of the Unix socket of a service, used instead of the TCP address.
+
+  timeout
+    The timeout of each request, in seconds.
+  """
+
+  def __init__(self, host = '127.0.0.1', port = 8765, socket_path = None, timeout = 60):
+    self.m_host = host
+    self.m_port = port
+    self.m_socket_path = socket_path
+    self.m_timeout = timeout
+    self.m_local = threading.local()
+
+  def __connection__(self):
+    if not hasattr(self.m_local, 'connection'):
+      if self.m_socket_path is not None:
+        self.m_local.connection = _UnixHTTPConnection(self.m_socket_path, self.m_timeout)
+      else:
+        self.m_local.connection = httplib.HTTPConnection(self.m_host, self.m_port, timeout = self.m_timeout)
+    return self.m_local.connection
+
+  def __query__(self, method, **kwargs):
+    body = json.dumps(kwargs)
+    for attempt in range(2):
+      connection = self.__connection__()
+      try:
+        connection.request('POST', '/' + method, body, {'Content-Type': 'application/json'})
+        response = json.loads(connection.getresponse().read().decode('utf-8'))
+        break
+      except (httplib.HTTPException, socket.error):
+        # the kept-alive connection may have been closed by the server
+        connection.close()
+        del self.m_local.connection
+        if attempt: raise
+    if 'error' in response:
+      raise ValueError(response['error'])
+    return response['result']
+
+  def protocol_names(self):
+    return self.__query__('protocol_names')
+
+  def groups(self):
+    return tuple(self.__query__('groups'))
+
+  def purposes(self):
+    return tuple(self.__query__('purposes'))
+
+  def client_hands(self):
+    return tuple(self.__query__('client_hands'))
+
+  def objects(self, protocol=None, groups=None, purposes=None, model_ids=None, order_by='id', shard=None, num_shards=None):
+    return [RemoteFile(**f) for f in self.__query__('objects', protocol=protocol, groups=groups, purposes=purposes, model_ids=model_ids, order_by=order_by, shard=shard, num_shards=num_shards)]
+
+  def clients(self, hands = None, protocol=None, groups=None):
+    return [RemoteClient(**c) for c in self.__query__('clients', hands=hands, protocol=protocol, groups=groups)]
+
+  def model_ids(self, hands = None, protocol=None, groups=None):
+    return self.__query__('model_ids', hands=hands, protocol=protocol, groups=groups)
+
+  def client_ids_from_model_ids(self, model_ids, unknown = -1):
+    import numpy
+    model_ids = [m.decode() if isinstance(m, bytes) else str(m) for m in model_ids]
+    return numpy.array(self.__query__('client_ids_from_model_ids', model_ids=model_ids, unknown=unknown), dtype = numpy.int64)
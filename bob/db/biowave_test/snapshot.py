@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+# Teodors Eglitis <teodors.eglitis@idiap.ch>
+#
+# Copyright (C) 2011-2016 Idiap Research Institute, Martigny, Switzerland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Binary snapshot of the BIOWAVE test catalog, written by ``create`` next to the
+database file, and a query front-end answering from it without SQLAlchemy.
+
+A snapshot file holds:
+
+* the 8 bytes magic ``BWTSNAP\\0``, followed by the little-endian ``uint32``
+  format version and the ``uint32`` length of a JSON header;
+* the JSON header, with the protocol names, groups, purposes and hands, the
+  build token ``create`` stored in the database file the snapshot was taken
+  from, and the offset, dtype and length of every array;
+* the arrays, each aligned to 8 bytes: the file ids, client ids, hand codes
+  and model ids of all files, sorted by file id, their paths as UTF-8 offsets
+  and data, the positions of the files sorted by model id, and for every
+  protocol, group and purpose the sorted positions of its files.
+"""
+
+import os
+import json
+import mmap
+import struct
+import sqlite3
+
+MAGIC = b'BWTSNAP\0'
+VERSION = 2
+_PREAMBLE = struct.Struct('<8sII')
+
+
+def snapshot_file(dbfile):
+  """Returns the path of the snapshot of the given database file"""
+
+  return os.path.splitext(dbfile)[0] + '.snapshot'
+
+
+def database_token(dbfile):
+  """Returns the build token ``create`` stored as ``PRAGMA user_version`` in a
+  database file, recorded in its snapshot to detect when the snapshot is
+  stale; it survives copying the files, unlike their modification times"""
+
+  from urllib.request import pathname2url
+  uri = 'file:%s?mode=ro' % pathname2url(os.path.abspath(dbfile))
+  connection = sqlite3.connect(uri, uri = True)
+  try:
+    return connection.execute('PRAGMA user_version').fetchone()[0]
+  finally:
+    connection.close()
+
+
+def write_snapshot(filename, dbfile, protocols, groups, purposes, hands, files, membership):
+  """Writes the snapshot of a database file.
+
+  Keyword Parameters:
+
+  filename
+    The snapshot file to write; it is replaced atomically.
+
+  dbfile
+    The database file the snapshot is taken from, holding its build token;
+    the snapshot becomes stale when ``create`` writes a new token.
+
+  protocols, groups, purposes, hands
+    The lists of valid protocol names, groups, purposes and hands.
+
+  files
+    A list of ``(file_id, client_id, hand, model_id, path)`` tuples.
+
+  membership
+    A list of ``(protocol, group, purpose, file_id)`` tuples.
+  """
+
+  import numpy
+  files = sorted(files)
+  position = dict((f[0], k) for k, f in enumerate(files))
+  paths = [f[4].encode('utf-8') for f in files]
+  arrays = [
+    ('file_id', numpy.array([f[0] for f in files], dtype='<i8')),
+    ('client_id', numpy.array([f[1] for f in files], dtype='<i8')),
+    ('hand', numpy.array([hands.index(f[2]) for f in files], dtype='u1')),
+    ('model_id', numpy.array([f[3].encode('ascii') for f in files], dtype='S%d' % max([1] + [len(f[3]) for f in files]))),
+    ('path_offsets', numpy.cumsum([0] + [len(p) for p in paths], dtype='<i8')),
+    ('path_data', numpy.frombuffer(b''.join(paths), dtype='u1')),
+    ]
+  # positions of the files sorted by model id, to look model ids up
+  arrays.append(('model_order', numpy.argsort(arrays[3][1], kind='mergesort').astype('<i4')))
+  keys = sorted(set(m[:3] for m in membership))
+  for key in keys:
+    positions = sorted(set(position[m[3]] for m in membership if m[:3] == key))
+    arrays.append(('membership/%s/%s/%s' % key, numpy.array(positions, dtype='<i4')))
+
+  header = {
+    'protocols': list(protocols), 'groups': list(groups), 'purposes': list(purposes), 'hands': list(hands),
+    'token': database_token(dbfile), 'arrays': {},
+    }
+  # the offsets depend on the header length, so it is computed twice
+  for k in range(2):
+    offset = _PREAMBLE.size + len(json.dumps(header).encode('utf-8'))
+    for name, array in arrays:
+      offset += -offset % 8
+      header['arrays'][name] = [offset, array.dtype.str, len(array)]
+      offset += array.nbytes
+  encoded = json.dumps(header).encode('utf-8')
+
+  temporary = '%s.%d.tmp' % (filename, os.getpid())
+  with open(temporary, 'wb') as f:
+    f.write(_PREAMBLE.pack(MAGIC, VERSION, len(encoded)))
+    f.write(encoded)
+    for name, array in arrays:
+      f.write(b'\0' * (header['arrays'][name][0] - f.tell()))
+      f.write(array.tobytes())
+  os.rename(temporary, filename)
+
+
+class Snapshot(object):
+  """Memory maps a snapshot file and gives access to its arrays.
+
+  Raises ``ValueError`` if the file is not a snapshot of the current
+  :py:data:`VERSION`.
+  """
+
+  def __init__(self, filename):
+    import numpy
+    with open(filename, 'rb') as f:
+      self.m_mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    magic, version, length = _PREAMBLE.unpack_from(self.m_mmap, 0)
+    if magic != MAGIC or version != VERSION:
+      self.m_mmap.close()
+      raise ValueError("'%s' is not a snapshot of version %d" % (filename, VERSION))
+    self.header = json.loads(self.m_mmap[_PREAMBLE.size:_PREAMBLE.size + length].decode('utf-8'))
+    # the file and its size and modification time at the last token check
+    self.m_checked = None
+    self.m_current = False
+    self.arrays = {}
+    for name, (offset, dtype, count) in self.header['arrays'].items():
+      self.arrays[name] = numpy.frombuffer(self.m_mmap, dtype = dtype, count = count, offset = offset)
+
+  def is_current(self, dbfile):
+    """Tells if the snapshot was taken from the given database file as it
+    currently is, by comparing their build tokens; the token is only read
+    again when the size or modification time of the file changed"""
+
+    try:
+      stat = os.stat(dbfile)
+      checked = (dbfile, stat.st_size, stat.st_mtime_ns)
+      if checked != self.m_checked:
+        self.m_current = self.header['token'] != 0 and database_token(dbfile) == self.header['token']
+        self.m_checked = checked
+      return self.m_current
+    except (OSError, sqlite3.Error):
+      return False
+
+  def positions(self, protocol, groups, purposes):
+    """Returns the sorted positions of the files in any of the given
+    protocols, groups and purposes"""
+
+    import numpy
+    parts = [self.arrays.get('membership/%s/%s/%s' % (p, g, u)) for p in protocol for g in groups for u in purposes]
+    parts = [k for k in parts if k is not None]
+    if not parts:
+      return numpy.zeros((0,), dtype = '<i4')
+    if len(parts) == 1:
+      return parts[0]
+    return numpy.unique(numpy.concatenate(parts))
+
+  def path(self, position):
+    """Returns the path of the file at the given position"""
+
+    offsets = self.arrays['path_offsets']
+    return self.arrays['path_data'][offsets[position]:offsets[position + 1]].tobytes().decode('utf-8')
+
+
+class SnapshotFile(object):
+  """A file read from a snapshot, with the attributes and path methods of
+  :py:class:`.File`"""
+
+  __slots__ = ('id', 'client_id', 'path', 'model_id')
+
+  def __init__(self, id, client_id, path, model_id):
+    self.id = id
+    self.client_id = client_id
+    self.path = path
+    self.model_id = model_id
+
+  @property
+  def get_client_id(self):
+    return self.client_id
+
+  def make_path(self, directory = None, extension = None):
+    return str(os.path.join(directory or '', self.path + (extension or '')))
+
+  def __repr__(self):
+    return "SnapshotFile(id = {}, Client id = {}, path = {})".format(self.id, self.client_id, self.path)
+
+
+class SnapshotDatabase(object):
+  """Answers :py:meth:`objects` and :py:meth:`model_ids`, and the lists of
+  valid protocols, groups, purposes and hands, from the snapshot written by
+  ``create`` next to the database file, without importing SQLAlchemy.
+
+  The files are returned as :py:class:`SnapshotFile` objects. When the
+  snapshot is missing, of another version, or taken from another build of
+  the database file, all queries go to a :py:class:`.Database` instead, and
+  so do all other methods of the :py:class:`.Database`.
+
+  Keyword Parameters:
+
+  original_directory, original_extension
+    The directory and extension of the images, as for the
+    :py:class:`.Database`.
+  """
+
+  def __init__(self, original_directory = None, original_extension = '.png'):
+    from . import SQLITE_FILE
+    self.original_directory = original_directory
+    self.original_extension = original_extension
+    self.m_sqlite_file = SQLITE_FILE
+    self.m_snapshot = None
+    self.m_database = None
+    self.m_cache = {}
+    try:
+      self.m_snapshot = Snapshot(snapshot_file(SQLITE_FILE))
+    except (IOError, OSError, ValueError):
+      pass
+
+  def __snapshot__(self):
+    """Returns the snapshot, or ``None`` if it can't be used"""
+
+    if self.m_snapshot is not None and not self.m_snapshot.is_current(self.m_sqlite_file):
+      self.m_snapshot = None
+      self.m_cache = {}
+    return self.m_snapshot
+
+  def __database__(self):
+    """Returns the :py:class:`.Database` answering the queries the snapshot
+    can't answer"""
+
+    if self.m_database is None:
+      from .query import Database
+      self.m_database = Database(self.original_directory, self.original_extension)
+    return self.m_database
+
+  def __getattr__(self, name):
+    if name.startswith('m_'):
+      raise AttributeError(name)
+    return getattr(self.__database__(), name)
+
+  def uses_snapshot(self):
+    """Tells if queries are currently answered from the snapshot"""
+
+    return self.__snapshot__() is not None
+
+  def __check__(self, parameters, description, valid):
+    """Checks parameters the same way as the :py:class:`.Database` does"""
+
+    if parameters is None:
+      return tuple(valid)
+    if isinstance(parameters, str):
+      parameters = (parameters,)
+    valid_set = valid if isinstance(valid, frozenset) else set(valid)
+    for p in parameters:
+      if p not in valid_set:
+        raise ValueError("Invalid %s '%s'. Valid values are %s, or lists/tuples of those" % (description, p, valid))
+    return tuple(parameters)
+
+  def protocol_names(self):
+    """Returns all registered protocol names"""
+
+    snapshot = self.__snapshot__()
+    if snapshot is None:
+      return self.__database__().protocol_names()
+    return list(snapshot.header['protocols'])
+
+  def groups(self):
+    """Returns the names of all registered groups"""
+
+    snapshot = self.__snapshot__()
+    if snapshot is None:
+      return self.__database__().groups()
+    return tuple(snapshot.header['groups'])
+
+  def purposes(self):
+    """Returns the list of allowed purposes"""
+
+    snapshot = self.__snapshot__()
+    if snapshot is None:
+      return self.__database__().purposes()
+    return tuple(snapshot.header['purposes'])
+
+  def client_hands(self):
+    """Returns the names of all hand choices"""
+
+    snapshot = self.__snapshot__()
+    if snapshot is None:
+      return self.__database__().client_hands()
+    return tuple(snapshot.header['hands'])
+
+  def model_ids(self, hands = None, protocol=None, groups=None):
+    """Returns the sorted list of model ids, as
+    :py:meth:`.Database.model_ids`"""
+
+    snapshot = self.__snapshot__()
+    if snapshot is None:
+      return self.__database__().model_ids(hands, protocol, groups)
+
+    hands = self.__check__(hands, "hand", self.client_hands())
+    protocol = self.__check__(protocol, "protocol", self.protocol_names())
+    groups = self.__check__(groups, "group", self.groups())
+
+    key = (tuple(hands), tuple(protocol), tuple(groups))
+    if key not in self.m_cache:
+      import numpy
+      arrays = snapshot.arrays
+      positions = snapshot.positions(protocol, groups, ('enroll',))
+      codes = [snapshot.header['hands'].index(h) for h in hands]
+      positions = positions[numpy.isin(arrays['hand'][positions], codes)]
+      # model ids are unique, so the ones of the positions in model id order are sorted
+      ordered = arrays['model_order'][numpy.isin(arrays['model_order'], positions)]
+      self.m_cache[key] = [m.decode('ascii') for m in arrays['model_id'][ordered].tolist()]
+    return list(self.m_cache[key])
+
+  def objects(self, protocol=None, groups=None, purposes=None, model_ids=None, order_by='id', shard=None, num_shards=None):
+    """Returns the list of :py:class:`SnapshotFile`, with the parameters and
+    in the order of :py:meth:`.Database.objects`"""
+
+    snapshot = self.__snapshot__()
+    if snapshot is None:
+      return self.__database__().objects(protocol, groups, purposes, model_ids, order_by, shard, num_shards)
+
+    import numpy
+    protocol = self.__check__(protocol, "protocol", self.protocol_names())
+    purposes = self.__check__(purposes, "purpose", self.purposes())
+    groups = self.__check__(groups, "group", self.groups())
+    if order_by not in ('id', 'client_id', 'model_id', 'path'):
+      raise ValueError("Invalid order_by '%s'. Valid values are ('id', 'client_id', 'model_id', 'path')" % (order_by,))
+    if (shard is None) != (num_shards is None):
+      raise ValueError("The parameters 'shard' and 'num_shards' must be given together")
+    if num_shards is not None and not 0 <= shard < num_shards:
+      raise ValueError("The shard %s must be between 0 and %d" % (shard, num_shards - 1))
+
+    # probes are never filtered by model ids, as in Database.objects()
+    if purposes and len(purposes) == 1 and 'probe' in purposes:
+      model_ids = None
+    if model_ids:
+      key = ('valid', tuple(protocol), tuple(groups))
+      if key not in self.m_cache:
+        self.m_cache[key] = frozenset(self.model_ids(protocol=protocol, groups=groups))
+      model_ids = self.__check__(model_ids, "model_ids", self.m_cache[key])
+
+    arrays = snapshot.arrays
+    positions = snapshot.positions(protocol, groups, purposes)
+    if model_ids:
+      # the model ids are valid, so they all are in the snapshot
+      order = arrays['model_order']
+      wanted = numpy.array(sorted(set(m.encode('ascii') for m in model_ids)), dtype=arrays['model_id'].dtype)
+      found = numpy.sort(order[numpy.searchsorted(arrays['model_id'][order], wanted)])
+      index = numpy.minimum(numpy.searchsorted(positions, found), len(positions) - 1)
+      positions = found[positions[index] == found] if len(positions) else positions
+
+    # positions are sorted by file id, which breaks the ties of the keys
+    if order_by == 'client_id':
+      positions = positions[numpy.argsort(arrays['client_id'][positions], kind='mergesort')]
+    elif order_by == 'model_id':
+      positions = positions[numpy.argsort(arrays['model_id'][positions], kind='mergesort')]
+    elif order_by == 'path':
+      positions = numpy.array(sorted(positions, key=snapshot.path), dtype=positions.dtype)
+
+    if num_shards is not None:
+      positions = positions[len(positions) * shard // num_shards:len(positions) * (shard + 1) // num_shards]
+
+    file_ids = arrays['file_id'][positions].tolist()
+    client_ids = arrays['client_id'][positions].tolist()
+    model_ids = arrays['model_id'][positions].tolist()
+    return [SnapshotFile(file_ids[k], client_ids[k], snapshot.path(p), model_ids[k].decode('ascii')) for k, p in enumerate(positions.tolist())]
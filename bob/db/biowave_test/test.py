@@ -25,9 +25,7 @@ def db_available(test):
   return wrapper
 
 
-@db_available
-def test_clients():
-  db = Database()
+def _check_clients(db):
 
   assert len(db.groups()) == 2
   assert len(db.client_hands()) == 2
@@ -48,6 +46,24 @@ def test_clients():
   assert len(db.clients(hands = "L", protocol = 'all', groups = 'dev')) == 20
   assert len(db.clients(hands = "L", protocol = 'all', groups = 'eval')) == 0
 
+  assert len(db.model_ids()) == 80
+  assert db.model_ids() == sorted(db.model_ids())
+  assert len(db.model_ids(groups = 'dev')) == 40
+  assert len(db.model_ids(hands = "L")) == 40
+  assert len(db.model_ids(hands = "R")) == 40
+  assert db.model_ids(hands = "L") == db.model_ids(groups = 'dev')
+  assert len(db.model_ids(hands = "L", groups = 'eval')) == 0
+
+  model_ids = db.model_ids()
+  client_ids = db.client_ids_from_model_ids(model_ids + ["unknown"])
+  assert list(client_ids[:-1]) == [db.client_id_from_model_id(m) for m in model_ids]
+  assert client_ids[-1] == -1
+  ids = [c.id for c in db.clients()]
+  assert db.has_client_ids(ids + [-1]).tolist() == [True] * len(ids) + [False]
+  clients = db.clients_by_ids(ids + [-1])
+  assert [c.id for c in clients[:-1]] == ids
+  assert clients[-1] is None
+
   #assert len(db.models()) == 40
   #assert len(db.models(hands = ["R", "L"])) == 40
   #assert len(db.models(hands = "L")) == 20
@@ -55,9 +71,7 @@ def test_clients():
   #assert len(db.models(groups='dev'))   == 20
   #assert len(db.models(groups='eval'))   == 20
 
-@db_available
-def test_objects():
-  db = Database()
+def _check_objects(db):
   # protocol ALL:
 
   assert len(db.objects()) == 200
@@ -124,6 +138,28 @@ def test_objects():
   assert db.objects(model_ids = ["c_40_i_1"])[0].get_client_id == 40
   assert db.objects(model_ids = ["c_40_i_2"])[0].get_client_id == 40
 
+  ids = [f.id for f in db.objects()]
+  assert ids == sorted(set(ids))
+  assert [f.id for f in db.objects()] == ids
+  assert [row[0] for row in db.object_rows(batch_size = 7)] == ids
+  assert [row[5] for row in db.object_rows(groups = 'dev', purposes = 'probe')] == [f.path for f in db.objects(groups = 'dev', purposes = 'probe')]
+  paths = [f.path for f in db.objects(order_by = 'path')]
+  assert paths == sorted(paths)
+  client_ids = [f.client_id for f in db.objects(groups = 'dev', order_by = 'client_id')]
+  assert client_ids == sorted(client_ids)
+
+  for num_shards in (1, 3, 7):
+    shards = [db.objects(shard = k, num_shards = num_shards) for k in range(num_shards)]
+    assert [f.id for shard in shards for f in shard] == ids
+    assert max(len(shard) for shard in shards) - min(len(shard) for shard in shards) <= 1
+    assert [[row[0] for row in db.object_rows(shard = k, num_shards = num_shards, batch_size = 5)] for k in range(num_shards)] == [[f.id for f in shard] for shard in shards]
+  shards = [db.objects(groups = 'eval', order_by = 'path', shard = k, num_shards = 4) for k in range(4)]
+  assert [f.id for shard in shards for f in shard] == [f.id for f in db.objects(groups = 'eval', order_by = 'path')]
+  for order_by in ('client_id', 'model_id', 'path'):
+    for k in range(3):
+      expected = [f.id for f in db.objects(groups = 'eval', order_by = order_by, shard = k, num_shards = 3)]
+      assert [row[0] for row in db.object_rows(groups = 'eval', order_by = order_by, shard = k, num_shards = 3)] == expected
+
   temp1 = db.objects(model_ids = ["c_7_i_1"], groups = 'dev', purposes='probe')
   temp1_ids = []
   for m in temp1:
@@ -155,14 +191,638 @@ def test_objects():
   assert temp1_ids == temp2_ids
 
 
+def test_import_time():
+  # importing the package must neither import SQLAlchemy nor open the database
+  import sys
+  import subprocess
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+  code = "import sys, bob.db.biowave_test; assert 'sqlalchemy' not in sys.modules; assert 'bob.db.biowave_test.query' not in sys.modules"
+  process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', code], env=env, stderr=subprocess.PIPE, universal_newlines=True)
+  _, importtime = process.communicate()
+  assert process.returncode == 0, importtime
+
+  # cumulative import time of the package itself, in microseconds
+  cumulative = [int(line.split('|')[1]) for line in importtime.splitlines() if line.split('|')[-1].strip() == 'bob.db.biowave_test']
+  assert len(cumulative) == 1
+  assert cumulative[0] < 100000, "importing bob.db.biowave_test took %d us" % cumulative[0]
+
+@db_available
+def test_clients():
+  _check_clients(Database())
+
+@db_available
+def test_clients_in_memory():
+  _check_clients(Database(in_memory=True))
+
+@db_available
+def test_objects():
+  _check_objects(Database())
+
+@db_available
+def test_objects_in_memory():
+  _check_objects(Database(in_memory=True))
+
+@db_available
+def test_read_only():
+  from . import query
+  db = Database(read_only=True)
+  assert db.m_immutable
+  _check_clients(db)
+  _check_objects(db)
+
+  # while the file is rebuilt, the default connection is used until the
+  # rebuild is finished
+  marker = query.building_marker(query.SQLITE_FILE)
+  open(marker, 'w').close()
+  try:
+    db = Database(read_only=True)
+    assert not db.m_immutable
+    _check_objects(db)
+  finally:
+    os.unlink(marker)
+  db.protocol_names()
+  assert db.m_immutable
+  db.m_session.close()
+
+@db_available
+def test_in_memory_consistency():
+  sql = Database()
+  mem = Database(in_memory=True)
+
+  assert sql.protocol_names() == mem.protocol_names()
+  assert sorted(p.id for p in sql.protocol_purposes()) == sorted(p.id for p in mem.protocol_purposes())
+  for groups in (None, 'dev', 'eval'):
+    for hands in (None, 'L', 'R'):
+      assert sql.model_ids(hands=hands, groups=groups) == mem.model_ids(hands=hands, groups=groups)
+      assert sorted(c.id for c in sql.clients(hands=hands, groups=groups)) == sorted(c.id for c in mem.clients(hands=hands, groups=groups))
+    for purposes in (None, 'enroll', 'probe'):
+      assert [f.id for f in sql.objects(groups=groups, purposes=purposes)] == [f.id for f in mem.objects(groups=groups, purposes=purposes)]
+      assert [f.id for f in sql.objects(groups=groups, purposes=purposes, order_by='path')] == [f.id for f in mem.objects(groups=groups, purposes=purposes, order_by='path')]
+      assert list(sql.object_rows(groups=groups, purposes=purposes)) == list(mem.object_rows(groups=groups, purposes=purposes))
+      for model_id in sql.model_ids(groups=groups)[:5]:
+        assert [f.id for f in sql.objects(groups=groups, purposes=purposes, model_ids=[model_id])] == [f.id for f in mem.objects(groups=groups, purposes=purposes, model_ids=[model_id])]
+  for model_id in sql.model_ids():
+    assert sql.client_id_from_model_id(model_id) == mem.client_id_from_model_id(model_id)
+  for client in sql.clients():
+    assert mem.has_client_id(client.id)
+    assert mem.client(client.id).id == client.id
+  assert not mem.has_client_id(-1)
+
+
+@db_available
+def test_membership_consistency():
+  from nose.plugins.skip import SkipTest
+  from .models import FileMembership, membership_select
+  db = Database()
+  if db.__membership__() is not FileMembership.__table__:
+    raise SkipTest("The database file was created without the file membership table; run 'bob_dbmanage.py biowave_test create -R' to add it")
+  columns = ['file_id', 'client_id', 'hand', 'model_id', 'path', 'protocol', 'sgroup', 'purpose']
+  table = FileMembership.__table__.c
+  materialised = sorted(tuple(row) for row in db.query(*[table[c] for c in columns]))
+  joined = sorted(tuple(row) for row in db.m_session.execute(membership_select()))
+  assert materialised == joined
+  assert len(materialised) == 200
+
+  # database files without the table are answered from the normalised tables
+  fallback = Database()
+  fallback.__cache__()['membership'] = membership_select().alias('fileMembership')
+  for groups in (None, 'dev', 'eval'):
+    assert db.model_ids(groups=groups) == fallback.model_ids(groups=groups)
+    assert [c.id for c in db.clients(groups=groups)] == [c.id for c in fallback.clients(groups=groups)]
+    assert [f.id for f in db.objects(groups=groups, order_by='path')] == [f.id for f in fallback.objects(groups=groups, order_by='path')]
+    assert list(db.object_rows(groups=groups, shard=1, num_shards=3)) == list(fallback.object_rows(groups=groups, shard=1, num_shards=3))
+
+@db_available
+def test_snapshot():
+  import sys
+  import subprocess
+  from . import SQLITE_FILE
+  from nose.plugins.skip import SkipTest
+  from .snapshot import SnapshotDatabase, SnapshotFile
+  db = Database()
+  snap = SnapshotDatabase()
+  if not snap.uses_snapshot():
+    raise SkipTest("There is no snapshot of the database file; run 'bob_dbmanage.py biowave_test create -R' to write it")
+  assert snap.protocol_names() == db.protocol_names()
+  for groups in (None, 'dev', 'eval'):
+    for hands in (None, 'L', 'R'):
+      assert snap.model_ids(hands=hands, groups=groups) == db.model_ids(hands=hands, groups=groups)
+    for purposes in (None, 'enroll', 'probe'):
+      for order_by in ('id', 'client_id', 'model_id', 'path'):
+        expected = [(f.id, f.client_id, f.path, f.model_id) for f in db.objects(groups=groups, purposes=purposes, order_by=order_by)]
+        assert [(f.id, f.client_id, f.path, f.model_id) for f in snap.objects(groups=groups, purposes=purposes, order_by=order_by)] == expected
+      for model_id in db.model_ids(groups=groups)[:3]:
+        assert [f.id for f in snap.objects(groups=groups, purposes=purposes, model_ids=[model_id])] == [f.id for f in db.objects(groups=groups, purposes=purposes, model_ids=[model_id])]
+  assert [f.id for f in snap.objects(shard=2, num_shards=3)] == [f.id for f in db.objects(shard=2, num_shards=3)]
+  # other methods are answered by the SQL database
+  assert len(snap.clients(hands='L')) == 20
+
+  # the snapshot is answered from without importing SQLAlchemy
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+  code = "import sys, bob.db.biowave_test as p; p.SQLITE_FILE = %r; db = p.SnapshotDatabase(); assert db.uses_snapshot(); assert len(db.objects(groups='dev', purposes='enroll')) == 40; assert len(db.model_ids()) == 80; assert 'sqlalchemy' not in sys.modules" % SQLITE_FILE
+  assert subprocess.call([sys.executable, '-c', code], env=env) == 0
+
+  # copying the files changes their modification times, but not the build
+  # token the snapshot is checked with
+  stat = os.stat(SQLITE_FILE)
+  try:
+    os.utime(SQLITE_FILE, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**10))
+    assert snap.uses_snapshot()
+    assert isinstance(snap.objects(groups='dev')[0], SnapshotFile)
+  finally:
+    os.utime(SQLITE_FILE, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+@db_available
+def test_trials():
+  import tempfile
+  import shutil
+  import numpy
+  db = Database()
+
+  t = db.trials('dev')
+  assert len(t) == 40 * 60
+  assert set(t['model_index']) == set(range(40))
+  assert set(t['probe_file_id']) == set(f.id for f in db.objects(groups = 'dev', purposes = 'probe'))
+  model_ids = db.model_ids(groups = 'dev')
+  for k in (0, 59, 60, len(t) - 1):
+    assert db.client_id_from_model_id(model_ids[t['model_index'][k]]) == t['model_client_id'][k]
+  assert 0 < numpy.sum(t['model_client_id'] == t['probe_client_id']) < len(t)
+
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    filename = os.path.join(temp_dir, 'trials.npy')
+    m = db.trials('dev', filename = filename)
+    assert isinstance(m, numpy.memmap)
+    assert (m == t).all()
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+@db_available
+def test_to_arrays():
+  import tempfile
+  import shutil
+  import numpy
+  from .export import write_arrays, read_arrays, has_arrow
+  for in_memory in (False, True):
+    db = Database(in_memory=in_memory)
+    arrays = db.to_arrays()
+    files = db.objects()
+    assert list(arrays['file_id']) == [f.id for f in files]
+    assert list(arrays['path']) == [f.path for f in files]
+    assert list(arrays['model_id']) == [f.model_id for f in files]
+    assert list(arrays['client_id']) == [f.client_id for f in files]
+    assert list(arrays['hand']) == [f.client.hand for f in files]
+    for group in db.groups():
+      for purpose in db.purposes():
+        assert list(arrays['file_id'][arrays['%s_%s' % (group, purpose)]]) == [f.id for f in db.objects(groups=group, purposes=purpose)]
+
+  tmpdir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    for extension in ('.npz', '.arrow', '.parquet') if has_arrow() else ('.npz',):
+      filename = os.path.join(tmpdir, 'catalog' + extension)
+      write_arrays(arrays, filename)
+      loaded = read_arrays(filename)
+      assert sorted(loaded) == sorted(arrays)
+      for name in arrays:
+        assert numpy.array_equal(loaded[name].astype(arrays[name].dtype), arrays[name]), name
+  finally:
+    shutil.rmtree(tmpdir)
+
+@db_available
+def test_load():
+  import numpy
+  db = Database()
+  objects = db.objects(groups = 'dev')
+  # a stand-in loader, so that no image files are needed
+  loader = lambda path: numpy.array([len(path), hash(path) % 1000])
+
+  loaded = list(db.load(objects, directory = '/images', extension = '.png', jobs = 3, prefetch = 5, loader = loader))
+  assert [f.id for f, _ in loaded] == [f.id for f in objects]
+  for f, data in loaded:
+    assert (data == loader(f.make_path('/images', '.png'))).all()
+
+  # stopping early must not hang
+  for k, _ in enumerate(db.load(objects, loader = loader, prefetch = 2)):
+    if k == 3: break
+
+  batch = db.load_batch(objects, directory = '/images', extension = '.png', jobs = 3, loader = loader)
+  assert batch.shape == (len(objects), 2)
+  assert (batch == numpy.array([data for _, data in loaded])).all()
+  out = numpy.zeros((len(objects), 2), dtype = batch.dtype)
+  assert db.load_batch(objects, directory = '/images', extension = '.png', loader = loader, out = out) is out
+  assert (out == batch).all()
+
+
+def test_image_cache():
+  import tempfile
+  import shutil
+  import time
+  import numpy
+  from . import ImageCache
+
+  temp_dir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    sources = []
+    for k in range(4):
+      sources.append(os.path.join(temp_dir, 'image_%d.raw' % k))
+      with open(sources[-1], 'wb') as f: f.write(bytes(bytearray([k] * 100)))
+    loader = lambda path: numpy.fromfile(path, dtype=numpy.uint8).reshape(10, 10)
+
+    cache = ImageCache(os.path.join(temp_dir, 'cache'), max_bytes = 3 * 300)
+    for k, path in enumerate(sources[:3]):
+      assert (cache.get(k, path, loader) == k).all()
+    assert (cache.misses, cache.hits) == (3, 0)
+    data = cache.get(0, sources[0], loader)
+    assert isinstance(data, numpy.memmap)
+    assert (data == 0).all()
+    assert (cache.misses, cache.hits) == (3, 1)
+
+    # a modified source file is decoded again
+    time.sleep(0.01)
+    with open(sources[1], 'wb') as f: f.write(bytes(bytearray([9] * 100)))
+    assert (cache.get(1, sources[1], loader) == 9).all()
+    assert cache.misses == 4
+
+    # the least recently used entry is evicted when the cache grows too large
+    time.sleep(0.01)
+    cache.get(0, sources[0], loader)
+    cache.get(3, sources[3], loader)
+    assert cache.evictions >= 1
+    assert cache.size() <= 3 * 300
+    hits = cache.hits
+    cache.get(0, sources[0], loader)
+    assert cache.hits == hits + 1
+
+    # a second instance on the same directory shares the entries
+    other = ImageCache(os.path.join(temp_dir, 'cache'))
+    assert (other.get(3, sources[3], loader) == 3).all()
+    assert (other.hits, other.misses) == (1, 0)
+
+    # an entry larger than the cache is returned and kept until the next one
+    small = ImageCache(os.path.join(temp_dir, 'small'), max_bytes = 50)
+    assert (small.get(0, sources[0], loader) == 0).all()
+    assert (small.get(0, sources[0], loader) == 0).all()
+    assert (small.hits, small.misses) == (1, 1)
+    assert (small.get(1, sources[1], loader) == 9).all()
+    assert small.evictions == 1
+    assert len(os.listdir(os.path.join(temp_dir, 'small', '00'))) == 0
+
+    # an entry removed by another process before it is mapped is still returned
+    evict = small.evict
+    small.evict = lambda keep: small.clear()
+    assert (small.get(2, sources[2], loader) == 2).all()
+    small.evict = evict
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def _make_image_tree(root, persons, images = 6):
+  """Writes a synthetic image tree of ``persons`` persons with two hands of
+  ``images`` images each, and dev (left hands) and eval (right hands) file
+  lists using the first four images of every hand"""
+
+  for person in persons:
+    for hand in ('Left', 'Right'):
+      directory = os.path.join(root, 'images', 'Person_%02d' % person, hand)
+      os.makedirs(directory)
+      for k in range(images):
+        with open(os.path.join(directory, 'img_%d.png' % k), 'wb') as f: f.write(b'image')
+  for name, hand in (('dev', 'Left'), ('eval', 'Right')):
+    with open(os.path.join(root, name + '.txt'), 'w') as f:
+      for person in persons:
+        for enroll in (0, 1):
+          for probe in (2, 3):
+            f.write('../Database_jpg_90/Person_%02d/%s/img_%d.jpg, ../Database_jpg_90/Person_%02d/%s/img_%d.jpg, 1\n' % (person, hand, enroll, person, hand, probe))
+
+def _create(root, dbfile, **options):
+  """Runs the ``create`` command on the image tree in ``root`` and returns
+  what it printed on stdout"""
+
+  import argparse
+  import contextlib
+  import io
+  from .create import create
+  args = dict(files = [dbfile], type = 'sqlite', recreate = False, update = False, verbose = 0, imagedir = os.path.join(root, 'images'),
+      devfile = os.path.join(root, 'dev.txt'), evalfile = os.path.join(root, 'eval.txt'), jobs = 4, hash = False)
+  args.update(options)
+  output = io.StringIO()
+  with contextlib.redirect_stdout(output), contextlib.redirect_stderr(io.StringIO()):
+    create(argparse.Namespace(**args))
+  return output.getvalue()
+
+def _files(dbfile):
+  """Returns the ``path -> (id, client_id, model_id)`` dictionary of the files
+  of a database file"""
+
+  import sqlite3
+  connection = sqlite3.connect(dbfile)
+  try:
+    return dict((path, (id, client_id, model_id)) for id, client_id, path, model_id in connection.execute('SELECT id, client_id, path, model_id FROM file'))
+  finally:
+    connection.close()
+
+def test_create():
+  import json
+  import shutil
+  import tempfile
+  from .create import DatabaseError
+
+  root = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    _make_image_tree(root, persons = (1, 2, 3))
+    dbfile = os.path.join(root, 'db', 'db.sql3')
+    _create(root, dbfile)
+    files = _files(dbfile)
+    assert len(files) == 36
+    assert sorted(i for i, _, _ in files.values()) == list(range(1, 37))
+    assert files['Person_01/Left/img_0'][1:] == (1, 'c_1_i_1')
+    assert files['Person_03/Right/img_5'][1:] == (6, 'c_6_i_6')
+
+    # the manifest does not depend on the number of concurrent listings
+    _create(root, os.path.join(root, 'db', 'serial.sql3'), jobs = 1)
+    assert _files(os.path.join(root, 'db', 'serial.sql3')) == files
+
+    # images and persons are added to and removed from the tree
+    os.remove(os.path.join(root, 'images', 'Person_02', 'Left', 'img_5.png'))
+    with open(os.path.join(root, 'images', 'Person_01', 'Left', 'img_6.png'), 'wb') as f: f.write(b'image')
+    _make_image_tree(os.path.join(root, 'new'), persons = (4,))
+    shutil.move(os.path.join(root, 'new', 'images', 'Person_04'), os.path.join(root, 'images'))
+    # the progress messages do not mix with the JSON delta
+    delta = json.loads(_create(root, dbfile, update = True, verbose = 2))
+    updated = _files(dbfile)
+    assert delta['removed'] == [files['Person_02/Left/img_5'][0]]
+    assert delta['added'] == list(range(37, 50))
+    assert sorted(updated[path][0] for path in set(updated) - set(files)) == delta['added']
+    # the files that did not change keep their ids and model ids
+    for path in set(files) & set(updated):
+      assert updated[path] == files[path]
+    # new images are numbered after the existing ones of the same client
+    assert updated['Person_01/Left/img_6'][1:] == (1, 'c_1_i_7')
+    assert updated['Person_04/Left/img_0'][1:] == (7, 'c_7_i_1')
+    # updating an unchanged tree does nothing
+    assert json.loads(_create(root, dbfile, update = True)) == {'added': [], 'removed': []}
+    assert _files(dbfile) == updated
+
+    # all bad file list entries are reported in one error
+    with open(os.path.join(root, 'dev.txt'), 'a') as f:
+      f.write('Person_09/Left/img_0.jpg, Person_01/Left/img_9.jpg, 1\n')
+    try:
+      _create(root, dbfile, recreate = True)
+      assert False, "bad file list entries were accepted"
+    except DatabaseError as e:
+      assert '2 entries have no corresponding file' in str(e)
+      assert 'Person_09/Left/img_0' in str(e) and 'Person_01/Left/img_9' in str(e)
+  finally:
+    shutil.rmtree(root)
+
+
+def test_snapshot_token():
+  import shutil
+  import tarfile
+  import tempfile
+  import time
+  from .snapshot import Snapshot, snapshot_file
+
+  root = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    _make_image_tree(root, persons = (1, 2))
+    dbfile = os.path.join(root, 'db', 'db.sql3')
+    _create(root, dbfile)
+    snapshot = Snapshot(snapshot_file(dbfile))
+    assert snapshot.is_current(dbfile)
+
+    # shipping the files changes their modification times, not the token
+    time.sleep(0.01)
+    with tarfile.open(os.path.join(root, 'db.tar'), 'w') as f:
+      f.add(dbfile, 'db.sql3')
+      f.add(snapshot_file(dbfile), 'db.snapshot')
+    with tarfile.open(os.path.join(root, 'db.tar')) as f:
+      f.extractall(os.path.join(root, 'shipped'))
+    shipped = os.path.join(root, 'shipped', 'db.sql3')
+    os.utime(shipped, None)
+    assert Snapshot(snapshot_file(shipped)).is_current(shipped)
+
+    # each build of the database gets a new token
+    _create(root, dbfile, update = True)
+    assert not snapshot.is_current(dbfile)
+    assert Snapshot(snapshot_file(dbfile)).is_current(dbfile)
+    assert not Snapshot(snapshot_file(shipped)).is_current(dbfile)
+  finally:
+    shutil.rmtree(root)
+
+
+def test_verify():
+  import shutil
+  import tempfile
+  from bob.db.base.utils import session_try_nolock
+  from .models import File
+  from .driver import modified_paths
+
+  root = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    _make_image_tree(root, persons = (1,))
+    dbfile = os.path.join(root, 'db', 'db.sql3')
+    _create(root, dbfile, hash = True)
+    session = session_try_nolock('sqlite', dbfile)
+    files = list(session.query(File).order_by(File.id))
+    paths = [f.make_path(os.path.join(root, 'images'), '.png') for f in files]
+    session.close()
+    def check(update_hashes = False):
+      session = session_try_nolock('sqlite', dbfile)
+      try:
+        return modified_paths(session, dbfile, files, paths, update_hashes = update_hashes)
+      finally:
+        session.close()
+    assert check() == ([], [], 0, [])
+
+    # touched files are hashed by every check, without writing the database
+    stat = os.stat(paths[0])
+    os.utime(paths[0], (stat.st_atime, stat.st_mtime + 10))
+    mtime = os.stat(dbfile).st_mtime_ns
+    assert check() == ([], [], 1, [])
+    assert check() == ([], [], 1, [])
+    assert os.stat(dbfile).st_mtime_ns == mtime
+    # unless their new times are recorded
+    assert check(update_hashes = True) == ([], [], 1, [])
+    assert not os.path.exists(dbfile + '.building')
+    assert check() == ([], [], 0, [])
+
+    # modified files are reported
+    with open(paths[1], 'wb') as f: f.write(b'modified')
+    assert check() == ([paths[1]], [], 1, [])
+    assert check() == ([paths[1]], [], 1, [])
+
+    # files removed after the directories were listed are reported as such
+    os.remove(paths[2])
+    assert check() == ([paths[1]], [], 1, [paths[2]])
+  finally:
+    shutil.rmtree(root)
+
+
+@db_available
+def test_async():
+  import asyncio
+  for in_memory in (False, True):
+    db = Database(in_memory = in_memory, async_jobs = 3)
+
+    async def queries():
+      return await asyncio.gather(
+          db.aobjects(groups = 'dev'),
+          db.aobjects(groups = 'eval', purposes = 'probe'),
+          db.aclients(hands = 'L'),
+          db.amodel_ids(groups = 'eval'),
+          db.aclient_ids_from_model_ids(['c_1_i_1']),
+          )
+    dev, eval_probe, clients, model_ids, client_ids = asyncio.run(queries())
+    assert [f.id for f in dev] == [f.id for f in db.objects(groups = 'dev')]
+    assert [f.id for f in eval_probe] == [f.id for f in db.objects(groups = 'eval', purposes = 'probe')]
+    assert sorted(c.id for c in clients) == sorted(c.id for c in db.clients(hands = 'L'))
+    assert model_ids == db.model_ids(groups = 'eval')
+    assert list(client_ids) == [1]
+
+    # cancelled queries do not break the following ones
+    async def cancelled():
+      tasks = [asyncio.ensure_future(db.aobjects()) for k in range(10)]
+      await asyncio.sleep(0)
+      for task in tasks: task.cancel()
+      await asyncio.gather(*tasks, return_exceptions = True)
+      assert all(task.cancelled() for task in tasks)
+      return await db.aobjects()
+    assert len(asyncio.run(cancelled())) == 200
+    db.close_async()
+    # the connection must not be garbage collected by another thread
+    db.m_session.close()
+
+
+@db_available
+def test_service():
+  import threading
+  import tempfile
+  import gc
+  from .service import make_server, RemoteDatabase, QueryHandler
+  # connections left over by other tests must not be garbage collected by the
+  # server threads
+  gc.collect()
+  db = Database()
+  socket_path = os.path.join(tempfile.mkdtemp(prefix = 'bobtest_'), 'service.sock')
+  for in_memory, address in ((False, {}), (True, {'socket_path': socket_path})):
+    server = make_server(in_memory = in_memory, pool_size = 2, **address)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.start()
+    try:
+      if 'socket_path' in address:
+        remote = RemoteDatabase(**address)
+      else:
+        remote = RemoteDatabase(port = server.server_address[1])
+      assert remote.protocol_names() == db.protocol_names()
+      assert [f.id for f in remote.objects(groups = 'dev')] == [f.id for f in db.objects(groups = 'dev')]
+      assert [f.path for f in remote.objects(protocol = 'all', groups = ['eval'], purposes = 'enroll')] == [f.path for f in db.objects(protocol = 'all', groups = 'eval', purposes = 'enroll')]
+      assert [c.id for c in remote.clients(hands = 'L')] == [c.id for c in db.clients(hands = 'L')]
+      # the order of the groups is kept, also for cached responses
+      for groups in (['eval', 'dev'], ['dev', 'eval'], ['eval', 'dev']):
+        assert [c.id for c in remote.clients(groups = groups)] == [c.id for c in db.clients(groups = groups)]
+      assert remote.model_ids(groups = 'eval') == db.model_ids(groups = 'eval')
+      assert list(remote.client_ids_from_model_ids(['c_1_i_1', 'unknown'])) == [1, -1]
+      # equivalent arguments are answered from the response cache
+      hits = server.query_handler.hits
+      remote.objects(groups = ['dev', 'dev'], purposes = ('probe', 'enroll'))
+      remote.objects(groups = 'dev', purposes = ['enroll', 'probe'])
+      assert server.query_handler.hits == hits + 1
+      # invalid values are reported to the client
+      try:
+        remote.objects(groups = 'unknown')
+        assert False, "an invalid group was accepted"
+      except ValueError as e:
+        assert 'unknown' in str(e)
+    finally:
+      server.shutdown()
+      server.server_close()
+      thread.join()
+
+  # the least recently used responses are dropped from a full cache
+  handler = QueryHandler(in_memory = True, cache_bytes = 1000)
+  model_ids = db.model_ids(groups = 'dev')[:20]
+  for model_id in model_ids:
+    handler('objects', {'groups': 'dev', 'purposes': 'enroll', 'model_ids': [model_id]})
+  count, size = handler.cache_size()
+  assert 0 < count < len(model_ids) and size <= 1000
+  handler('objects', {'groups': 'dev', 'purposes': 'enroll', 'model_ids': [model_ids[-1]]})
+  handler('objects', {'groups': 'dev', 'purposes': 'enroll', 'model_ids': [model_ids[0]]})
+  assert (handler.hits, handler.misses) == (1, len(model_ids) + 1)
+
+  # the in-memory catalog is read again when the database file changes
+  shared = handler.m_shared
+  handler.m_stamp = None
+  handler('model_ids', {})
+  assert handler.m_shared is not shared and handler.cache_size()[0] == 1
+  db.m_session.close()
+
+
+def test_write_rows():
+  import io
+  import csv
+  import json
+  from .driver import write_rows
+  # file 2 is listed for two purposes, file 3 for two groups
+  rows = [
+      (1, 1, 'c_1_i_1', 'dev', 'enroll', 'Person_01/Left/img_0'),
+      (2, 1, 'c_1_i_2', 'dev', 'enroll', 'Person_01/Left/img_1'),
+      (2, 1, 'c_1_i_2', 'dev', 'probe', 'Person_01/Left/img_1'),
+      (3, 2, 'c_2_i_1', 'dev', 'probe', 'Person_01/Right/img_0'),
+      (3, 2, 'c_2_i_1', 'eval', 'probe', 'Person_01/Right/img_0'),
+      ]
+  paths = ['/db/Person_01/Left/img_0.png', '/db/Person_01/Left/img_1.png', '/db/Person_01/Right/img_0.png']
+
+  def write(format, batch_size):
+    output = io.StringIO()
+    write_rows(output, rows, format, '/db', '.png', batch_size)
+    return output.getvalue()
+
+  # the duplicates are dropped across batch boundaries as well
+  for batch_size in (1, 2, 1000):
+    assert write('plain', batch_size) == ''.join(p + '\n' for p in paths)
+    assert write('null', batch_size) == ''.join(p + '\0' for p in paths)
+
+    records = list(csv.reader(io.StringIO(write('csv', batch_size))))
+    assert records[0] == ['id', 'client_id', 'model_id', 'group', 'purpose', 'path']
+    assert records[1:] == [[str(r[0]), str(r[1]), r[2], r[3], r[4], '/db/%s.png' % r[5]] for r in rows]
+
+    records = [json.loads(line) for line in write('jsonl', batch_size).splitlines()]
+    assert records == [{'id': r[0], 'client_id': r[1], 'model_id': r[2], 'group': r[3], 'purpose': r[4], 'path': '/db/%s.png' % r[5]} for r in rows]
+
+  assert write('csv', 10) == 'id,client_id,model_id,group,purpose,path\n' + ''.join('%d,%d,%s,%s,%s,/db/%s.png\n' % r for r in rows)
+  # no rows only give the header
+  output = io.StringIO()
+  write_rows(output, [], 'csv', None, None)
+  assert output.getvalue() == 'id,client_id,model_id,group,purpose,path\n'
+
 
 @db_available
 def test_driver_api():
+  import tempfile
+  import shutil
   from bob.db.base.script.dbmanage import main
   assert main('biowave_test dumplist --self-test'.split()) == 0
   assert main('biowave_test dumplist --protocol=all --group=dev --purpose=enroll --self-test'.split()) == 0
   assert main('biowave_test dumplist --protocol=all --group=dev --purpose=enroll --models=c_7_i_1 --self-test'.split()) == 0
+  assert main('biowave_test dumplist --models=unknown --self-test'.split()) == 1
+  assert main('biowave_test dumplist --shard=1 --num-shards=3 --self-test'.split()) == 0
+  assert main('biowave_test dumplist --shard=1 --self-test'.split()) == 1
+  assert main('biowave_test dumplist --shard=3 --num-shards=3 --self-test'.split()) == 1
+  for format in ('plain', 'null', 'csv', 'jsonl'):
+    assert main(('biowave_test dumplist --format=%s --group=dev --self-test' % format).split()) == 0
   assert main('biowave_test checkfiles --self-test'.split()) == 0
+  assert main('biowave_test checkfiles --jobs=4 --json --self-test'.split()) == 0
+  assert main('biowave_test checkfiles --verify --self-test'.split()) == 0
+  assert main('biowave_test checkfiles --verify --update-hashes --self-test'.split()) == 0
   assert main('biowave_test reverse Person_01/Left/BioPic_20160425_114336 --self-test'.split()) == 0
   assert main('biowave_test path 2 --self-test'.split()) == 0
+  assert main('biowave_test serve --port=0 --self-test'.split()) == 0
+  tmpdir = tempfile.mkdtemp(prefix='bobtest_')
+  try:
+    assert main(('biowave_test export --format=npz --output=%s --self-test' % os.path.join(tmpdir, 'catalog.{ext}')).split()) == 0
+    assert os.path.exists(os.path.join(tmpdir, 'catalog.npz'))
+  finally:
+    shutil.rmtree(tmpdir)
   assert main('biowave_test download --force'.split()) is None